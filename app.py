@@ -1,8 +1,12 @@
 import os
+import hashlib
 import logging
 from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.pool import QueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
 # Configure logging
 logging.basicConfig(
@@ -19,15 +23,29 @@ def get_database_url():
     db_url = os.environ.get("DATABASE_URL")
     if db_url and db_url.startswith("postgres://"):
         db_url = db_url.replace("postgres://", "postgresql://", 1)
-    logger.info(f"Using database URL: {db_url}")
     return db_url
 
+def get_async_database_url(db_url: str):
+    """Map the database URL to an async driver (asyncpg or aiosqlite)"""
+    if db_url.startswith("postgresql://"):
+        db_url = db_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+        # asyncpg не понимает sslmode, вместо него используется ssl
+        db_url = db_url.replace("sslmode=", "ssl=")
+    elif db_url.startswith("sqlite://"):
+        db_url = db_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return db_url
+
+# URL читается один раз, в лог попадает без пароля
+DATABASE_URL = get_database_url()
+ASYNC_DATABASE_URL = get_async_database_url(DATABASE_URL)
+logger.info(f"Using database URL: {make_url(DATABASE_URL).render_as_string(hide_password=True)}")
+
 # Create database engine with optimized settings
 engine = create_engine(
-    get_database_url(),
+    DATABASE_URL,
     poolclass=QueuePool,
-    pool_size=10,
-    max_overflow=20,
+    pool_size=int(os.environ.get("DB_POOL_SIZE", "10")),
+    max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "20")),
     pool_pre_ping=True,
     pool_recycle=300,
 )
@@ -42,66 +60,160 @@ Session = sessionmaker(
 def get_session():
     return Session()
 
+# Async engine used by the bot handlers, the sync one stays for startup and maintenance
+def _async_pool_settings(db_url: str) -> dict:
+    # Для aiosqlite пул выбирает сам SQLAlchemy (NullPool/StaticPool), размеры пула он не принимает
+    if db_url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+        "pool_pre_ping": True,
+        "pool_recycle": 300,
+    }
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    **_async_pool_settings(ASYNC_DATABASE_URL),
+)
+
+AsyncSession = async_sessionmaker(
+    bind=async_engine,
+    expire_on_commit=False,
+)
+
+def get_async_session():
+    return AsyncSession()
+
+def _add_missing_columns():
+    """Add columns declared in models but missing in existing tables.
+
+    create_all only creates new tables, so new nullable or server-defaulted
+    columns are added here with ALTER TABLE.
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                connection.execute(text(ddl))
+                logger.info(f"Added missing column {table.name}.{column.name}")
+
+def _create_missing_indexes() -> bool:
+    """Create indexes declared in models but missing in existing tables.
+
+    Returns False if some index could not be created.
+    """
+    created_all = True
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            try:
+                index.create(engine)
+                logger.info(f"Created missing index {index.name} on {table.name}")
+            except Exception as e:
+                # Например, уникальный индекс не создается из-за дубликатов в старых данных
+                logger.error(f"Failed to create index {index.name} on {table.name}: {str(e)}")
+                created_all = False
+    return created_all
+
+def schema_fingerprint() -> str:
+    """Marker of the schema declared in models and migrations: tables, columns, indexes, migration versions."""
+    from migrations import MIGRATIONS
+    parts = [migration.version for migration in MIGRATIONS]
+    for table in Base.metadata.sorted_tables:
+        parts.append(table.name)
+        for column in table.columns:
+            default = column.server_default.arg if column.server_default is not None else ""
+            parts.append(f"{column.name}:{column.type}:{column.nullable}:{column.unique}:{default}")
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            options = sorted(f"{key}={value}" for key, value in index.dialect_kwargs.items())
+            parts.append(f"{index.name}:{','.join(column.name for column in index.columns)}:{index.unique}:{options}")
+    return "models-" + hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()[:32]
+
+def _schema_is_current(marker: str) -> bool:
+    try:
+        with engine.connect() as connection:
+            return connection.execute(
+                text("SELECT 1 FROM schema_migrations WHERE version = :version"),
+                {"version": marker}
+            ).first() is not None
+    except SQLAlchemyError:
+        # Таблицы маркеров еще нет - схему нужно проверить полностью
+        return False
+
+def _mark_schema_current(marker: str) -> None:
+    from migrations import record_version
+    with engine.begin() as connection:
+        record_version(connection, marker)
+
 def init_db():
     """Initialize database with improved error handling and data management"""
     try:
         # Import models here to avoid circular imports
         import models  # noqa: F401
-        from content.lessons import LESSONS
-        from content.quizzes import QUIZZES
-        from models import Lesson, Quiz, User, Progress, UserStatistics
+        from content.store import content_store
+        from models import User
 
         logger.info("Starting database initialization...")
 
-        # Create tables if they don't exist
-        Base.metadata.create_all(engine)
-        logger.info("Database tables created or already exist")
+        # Проверка таблиц, колонок и индексов нужна только если модели изменились
+        marker = schema_fingerprint()
+        if _schema_is_current(marker):
+            logger.info(f"Schema marker {marker} is current, skipping schema checks")
+        else:
+            from migrations import run_migrations, schema_lock
+            # Воркеры, стартующие одновременно, меняют схему по очереди
+            with schema_lock(engine):
+                if _schema_is_current(marker):
+                    logger.info(f"Schema marker {marker} was written by another process")
+                else:
+                    # Create tables if they don't exist
+                    Base.metadata.create_all(engine)
+                    _add_missing_columns()
+                    # Миграции идут до индексов: они готовят данные под новые ограничения
+                    run_migrations(engine)
+                    if _create_missing_indexes():
+                        _mark_schema_current(marker)
+                    logger.info("Database tables created or already exist")
 
         session = get_session()
         try:
-            # Check if we need to initialize data
-            existing_lessons = session.query(Lesson).count()
-            existing_quizzes = session.query(Quiz).count()
-
-            if existing_lessons == 0:
-                logger.info("No lessons found, initializing lesson data...")
-                # Add or update lessons
-                for lesson_id, lesson_data in LESSONS.items():
-                    lesson = Lesson(
-                        id=lesson_id,
-                        title=lesson_data['title'],
-                        content=lesson_data['content'],
-                        check_question=lesson_data['check_question'],
-                        check_options=str(lesson_data['check_options']),
-                        check_correct=lesson_data['check_correct'],
-                        materials=str(lesson_data['materials']),
-                        order=lesson_id
-                    )
-                    session.add(lesson)
-                    logger.info(f"Added new lesson: {lesson_id} - {lesson_data['title']}")
-
-            if existing_quizzes == 0:
-                logger.info("No quizzes found, initializing quiz data...")
-                # Add or update quizzes
-                for quiz_id, quiz_data in QUIZZES.items():
-                    quiz = Quiz(
-                        lesson_id=quiz_id,
-                        title=quiz_data['title'],
-                        question=quiz_data['question'],
-                        correct_answer=quiz_data['correct_answer'],
-                        explanation=quiz_data['explanation']
-                    )
-                    session.add(quiz)
-                    logger.info(f"Added new quiz for lesson: {quiz_id}")
-
-            session.commit()
+            # Переписываем только уроки и тесты с изменившимся хэшем контента
+            from utils.db_utils import sync_content
+            sync_content(content_store.lessons(), content_store.quizzes())
+
+            # Таблица воронки появилась позже остальных, заполняем ее по уже накопленным данным
+            from models import LessonFunnel
+            if session.query(LessonFunnel.lesson_id).first() is None and session.query(User.id).first() is not None:
+                from utils.db_utils import rebuild_lesson_funnel
+                rebuild_lesson_funnel()
+
             logger.info("Database initialization completed successfully")
 
-            # Log table statistics
-            inspector = inspect(engine)
-            for table_name in inspector.get_table_names():
-                result = session.execute(text(f"SELECT COUNT(*) FROM {table_name}")).scalar()
-                logger.info(f"Table {table_name} contains {result} records")
+            # Полный подсчет строк на больших таблицах медленный, поэтому только по запросу
+            if os.environ.get("LOG_TABLE_COUNTS", "0") == "1":
+                inspector = inspect(engine)
+                for table_name in inspector.get_table_names():
+                    result = session.execute(text(f"SELECT COUNT(*) FROM {table_name}")).scalar()
+                    logger.info(f"Table {table_name} contains {result} records")
 
         except Exception as e:
             logger.error(f"Error during database initialization: {str(e)}", exc_info=True)
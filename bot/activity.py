@@ -0,0 +1,102 @@
+import os
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+from utils.db_utils import apply_activity_batch
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = int(os.environ.get("ACTIVITY_FLUSH_INTERVAL_MS", "2000")) / 1000  # seconds
+FLUSH_MAX_EVENTS = int(os.environ.get("ACTIVITY_FLUSH_MAX_EVENTS", "500"))
+
+class ActivityBuffer:
+    """Write-behind buffer for last_activity and wrong quiz answers.
+
+    Handlers record events in memory; a background task merges activity per
+    user and flushes every FLUSH_INTERVAL or after FLUSH_MAX_EVENTS events.
+    Wrong answers are written as failed lesson attempts and counted in
+    total_attempts and the lesson funnel.
+    """
+
+    def __init__(self, flush_interval: float, max_events: int):
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self._pending: Dict[int, Dict] = {}
+        self._wrong_answers: List[Dict] = []
+        self._events = 0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def record(self, user_id: int) -> None:
+        self._pending[user_id] = {"user_id": user_id, "last_activity": datetime.utcnow()}
+
+        self._events += 1
+        if self._events >= self.max_events:
+            self._wakeup.set()
+
+    def record_wrong_answer(self, user_id: int, lesson_id: int) -> None:
+        self._wrong_answers.append({"user_id": user_id, "lesson_id": lesson_id, "answered_at": datetime.utcnow()})
+        self.record(user_id)
+
+    def _merge_back(self, events, wrong_answers) -> None:
+        # Неудачный пакет возвращаем в буфер, более свежие события сохраняются
+        for event in events:
+            self._pending.setdefault(event["user_id"], event)
+        self._wrong_answers = wrong_answers + self._wrong_answers
+
+    async def flush(self) -> int:
+        """Write all pending events, returns the number of users updated."""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            events = list(self._pending.values())
+            wrong_answers = self._wrong_answers
+            self._pending = {}
+            self._wrong_answers = []
+            self._events = 0
+
+            start_time = time.time()
+            if not await apply_activity_batch(events, wrong_answers):
+                self._merge_back(events, wrong_answers)
+                return 0
+            logger.debug(
+                f"Flushed activity of {len(events)} users and {len(wrong_answers)} wrong answers "
+                f"in {time.time() - start_time:.3f} seconds"
+            )
+            return len(events)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing activity buffer: {str(e)}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background task and write whatever is still buffered."""
+        if self._task is not None:
+            # Не отменяем задачу, чтобы не прервать запись пакета на середине
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        flushed = await self.flush()
+        logger.info(f"Activity buffer stopped, final flush wrote {flushed} users")
+
+activity_buffer = ActivityBuffer(FLUSH_INTERVAL, FLUSH_MAX_EVENTS)
@@ -1,15 +1,13 @@
 import os
-from openai import OpenAI
 import logging
-from functools import lru_cache
 import json
 import time
-from typing import Optional
+from typing import AsyncIterator, Optional
+from bot.ai_scheduler import scheduler, SchedulerBusy
+from bot.response_cache import response_cache
 
 logger = logging.getLogger(__name__)
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-
 # Уменьшаем размеры ответов и добавляем таймауты
 TIMEOUT = 10  # seconds
 MAX_TOKENS = {
@@ -18,62 +16,194 @@ MAX_TOKENS = {
     'history': 300      # было 400
 }
 
-@lru_cache(maxsize=50)
-def get_ml_explanation(topic: str) -> str:
+_client = None
+
+def get_client():
+    """Create the OpenAI client on first use.
+
+    Importing openai takes a noticeable part of startup, so the import and
+    the connection pool are deferred until the first AI request.
+    """
+    global _client
+    if _client is None:
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        # Собственный пул соединений для асинхронного клиента OpenAI
+        pool_limits = httpx.Limits(
+            max_connections=int(os.environ.get("OPENAI_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.environ.get("OPENAI_MAX_KEEPALIVE", "10")),
+        )
+        _client = AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            http_client=DefaultAsyncHttpxClient(limits=pool_limits, timeout=TIMEOUT),
+        )
+        logger.info("OpenAI client created")
+    return _client
+
+async def close_client():
+    """Close the AI client connection pool if it was ever opened."""
+    global _client
+    if _client is None:
+        return
+    await _client.close()
+    _client = None
+    logger.info("OpenAI client connection pool closed")
+
+def _explanation_messages(topic: str) -> list:
+    return [
+        {
+            "role": "system",
+            "content": "Кратко объясните ML концепцию. Максимум 2-3 предложения."
+        },
+        {
+            "role": "user",
+            "content": f"Объясните: {topic}"
+        }
+    ]
+
+def _question_messages(question: str) -> list:
+    return [
+        {
+            "role": "system",
+            "content": "Отвечайте кратко, максимум 2 предложения."
+        },
+        {
+            "role": "user",
+            "content": question
+        }
+    ]
+
+async def _stream_chat(kind: str, key: str, messages: list, max_tokens: int) -> AsyncIterator[str]:
+    """Yield a chat completion piece by piece, serving cached answers in one piece.
+
+    The full answer is cached only when the stream finished without errors;
+    an empty or interrupted stream ends with a short error note.
+    """
+    cached = await response_cache.get(kind, key)
+    if cached is not None:
+        yield cached
+        return
+
+    start_time = time.time()
+    parts = []
+    try:
+        async with scheduler.slot('chat'):
+            stream = await get_client().chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.5,
+                timeout=TIMEOUT,
+                stream=True
+            )
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                if not parts:
+                    logger.info(f"OpenAI {kind} first token after {time.time() - start_time:.2f} seconds")
+                parts.append(delta)
+                yield delta
+        logger.info(f"OpenAI {kind} stream took {time.time() - start_time:.2f} seconds")
+        if not parts:
+            logger.error(f"OpenAI {kind} stream returned no content")
+            yield "Извините, произошла ошибка. Попробуйте позже."
+            return
+        await response_cache.set(kind, key, "".join(parts))
+    except SchedulerBusy:
+        raise
+    except Exception as e:
+        logger.error(f"Error streaming ML {kind}: {e}")
+        if not parts:
+            yield "Извините, произошла ошибка. Попробуйте позже."
+        else:
+            # Пользователь должен видеть, что ответ неполный
+            yield "\n\n⚠️ Ответ прерван. Попробуйте спросить еще раз."
+
+def stream_ml_explanation(topic: str) -> AsyncIterator[str]:
+    """Stream an explanation of a machine learning concept."""
+    return _stream_chat('explanation', topic, _explanation_messages(topic), MAX_TOKENS['explanation'])
+
+def stream_ml_question(question: str) -> AsyncIterator[str]:
+    """Stream an answer to a question about machine learning."""
+    return _stream_chat('question', question, _question_messages(question), MAX_TOKENS['question'])
+
+async def get_ml_explanation(topic: str) -> str:
     """Get an explanation of a machine learning concept using GPT."""
+    cached = await response_cache.get('explanation', topic)
+    if cached is not None:
+        return cached
+
     start_time = time.time()
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Кратко объясните ML концепцию. Максимум 2-3 предложения."
-                },
-                {
-                    "role": "user",
-                    "content": f"Объясните: {topic}"
-                }
-            ],
-            max_tokens=MAX_TOKENS['explanation'],
-            temperature=0.5,  # Уменьшаем для более четких ответов
-            timeout=TIMEOUT
-        )
+        async with scheduler.slot('chat'):
+            response = await get_client().chat.completions.create(
+                model="gpt-4",
+                messages=_explanation_messages(topic),
+                max_tokens=MAX_TOKENS['explanation'],
+                temperature=0.5,  # Уменьшаем для более четких ответов
+                timeout=TIMEOUT
+            )
         logger.info(f"OpenAI explanation request took {time.time() - start_time:.2f} seconds")
-        return response.choices[0].message.content
+        content = response.choices[0].message.content
+        # В кэш попадают только успешные ответы, сообщения об ошибках не сохраняются
+        await response_cache.set('explanation', topic, content)
+        return content
+    except SchedulerBusy:
+        raise
     except Exception as e:
         logger.error(f"Error getting ML explanation: {e}")
         return "Извините, произошла ошибка. Попробуйте позже."
 
-@lru_cache(maxsize=50)
-def analyze_ml_question(question: str) -> str:
+async def analyze_ml_question(question: str) -> str:
     """Analyze and answer a question about machine learning."""
+    cached = await response_cache.get('question', question)
+    if cached is not None:
+        return cached
+
     start_time = time.time()
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Отвечайте кратко, максимум 2 предложения."
-                },
-                {
-                    "role": "user",
-                    "content": question
-                }
-            ],
-            max_tokens=MAX_TOKENS['question'],
-            temperature=0.5,
-            timeout=TIMEOUT
-        )
+        async with scheduler.slot('chat'):
+            response = await get_client().chat.completions.create(
+                model="gpt-4",
+                messages=_question_messages(question),
+                max_tokens=MAX_TOKENS['question'],
+                temperature=0.5,
+                timeout=TIMEOUT
+            )
         logger.info(f"OpenAI question analysis request took {time.time() - start_time:.2f} seconds")
-        return response.choices[0].message.content
+        content = response.choices[0].message.content
+        await response_cache.set('question', question, content)
+        return content
+    except SchedulerBusy:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing ML question: {e}")
         return "Извините, произошла ошибка. Попробуйте позже."
 
-def get_random_ml_history() -> dict:
-    """Get a random historical fact about machine learning with a test question."""
+HISTORY_FIELDS = ('history', 'question', 'correct_answer', 'explanation')
+
+def validate_history_item(data) -> Optional[dict]:
+    """Check a generated history item and normalize its answer letter."""
+    if not isinstance(data, dict):
+        return None
+    if not all(isinstance(data.get(key), str) and data[key].strip() for key in HISTORY_FIELDS):
+        return None
+
+    correct_answer = data['correct_answer'].strip().upper()[:1]
+    if correct_answer not in ('A', 'B', 'C'):
+        return None
+
+    item = {key: data[key].strip() for key in HISTORY_FIELDS}
+    item['correct_answer'] = correct_answer
+    return item
+
+async def generate_ml_history_item() -> Optional[dict]:
+    """Generate a historical fact about machine learning with a test question.
+
+    Returns None if the response could not be parsed or validated.
+    """
     start_time = time.time()
     try:
         # Добавляем случайность в промпт для получения разных историй
@@ -87,48 +217,45 @@ def get_random_ml_history() -> dict:
         from random import choice
         current_prompt = choice(prompts)
 
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        f"{current_prompt}. "
-                        "Format the response as JSON with the structure:\n"
-                        "{\n"
-                        "  \"history\": \"historical fact about ML\",\n"
-                        "  \"question\": \"test question with options A, B, C\",\n"
-                        "  \"correct_answer\": \"A, B, or C\",\n"
-                        "  \"explanation\": \"explanation of the correct answer\"\n"
-                        "}"
-                    )
-                }
-            ],
-            max_tokens=MAX_TOKENS['history'],
-            temperature=0.8,  # Увеличиваем для большей вариативности
-            timeout=TIMEOUT
-        )
+        async with scheduler.slot('chat'):
+            response = await get_client().chat.completions.create(
+                model="gpt-4",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": (
+                            f"{current_prompt}. "
+                            "Format the response as JSON with the structure:\n"
+                            "{\n"
+                            "  \"history\": \"historical fact about ML\",\n"
+                            "  \"question\": \"test question with options A, B, C\",\n"
+                            "  \"correct_answer\": \"A, B, or C\",\n"
+                            "  \"explanation\": \"explanation of the correct answer\"\n"
+                            "}"
+                        )
+                    }
+                ],
+                max_tokens=MAX_TOKENS['history'],
+                temperature=0.8,  # Увеличиваем для большей вариативности
+                timeout=TIMEOUT
+            )
+        logger.info(f"OpenAI history request took {time.time() - start_time:.2f} seconds")
         content = response.choices[0].message.content
         try:
-            return json.loads(content)
+            item = validate_history_item(json.loads(content))
         except json.JSONDecodeError as e:
             logger.error(f"Failed to parse JSON response: {e}, content: {content}")
-            return {
-                "history": "Извините, произошла ошибка при получении исторической справки.",
-                "question": "Попробуйте позже.",
-                "correct_answer": "A",
-                "explanation": "Произошла ошибка при обработке ответа."
-            }
+            return None
+        if item is None:
+            logger.warning(f"Generated history item failed validation: {content}")
+        return item
+    except SchedulerBusy:
+        raise
     except Exception as e:
         logger.error(f"Error getting ML history: {str(e)}")
-        return {
-            "history": "Извините, произошла ошибка.",
-            "question": "Попробуйте позже.",
-            "correct_answer": "A",
-            "explanation": "Произошла ошибка при получении данных."
-        }
+        return None
 
-def generate_ml_meme(concept: Optional[str] = None) -> Optional[str]:
+async def generate_ml_meme(concept: Optional[str] = None) -> Optional[str]:
     """Generate a meme about machine learning using DALL-E."""
     start_time = time.time()
     try:
@@ -138,16 +265,19 @@ def generate_ml_meme(concept: Optional[str] = None) -> Optional[str]:
             f"Create a simple, minimalist meme about {concept} in machine learning"
         )
 
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            n=1,
-            size="1024x1024",
-            quality="standard",
-            timeout=TIMEOUT
-        )
+        async with scheduler.slot('image'):
+            response = await get_client().images.generate(
+                model="dall-e-3",
+                prompt=prompt,
+                n=1,
+                size="1024x1024",
+                quality="standard",
+                timeout=TIMEOUT
+            )
         logger.info(f"OpenAI meme generation request took {time.time() - start_time:.2f} seconds")
         return response.data[0].url if response.data else None
+    except SchedulerBusy:
+        raise
     except Exception as e:
         logger.error(f"Error generating ML meme: {str(e)}")
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,121 @@
+import os
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних ожиданий храним для расчета перцентилей
+WAIT_SAMPLES = 500
+
+class SchedulerBusy(Exception):
+    """Raised when an AI request queue is full or the wait took too long."""
+
+    def __init__(self, kind: str):
+        super().__init__(f"AI queue '{kind}' is busy")
+        self.kind = kind
+
+class _Lane:
+    """Concurrency limit plus a bounded waiting queue for one kind of AI request."""
+
+    def __init__(self, kind: str, concurrency: int, max_queue: int, queue_timeout: float):
+        self.kind = kind
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=WAIT_SAMPLES)
+
+    @asynccontextmanager
+    async def slot(self):
+        start_time = time.monotonic()
+        if not self._semaphore.locked():
+            # Свободный слот захватывается без ожидания
+            await self._semaphore.acquire()
+        else:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                logger.warning(f"AI queue '{self.kind}' is full ({self.waiting} waiting), rejecting request")
+                raise SchedulerBusy(self.kind)
+
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                logger.warning(f"AI queue '{self.kind}' wait exceeded {self.queue_timeout}s, rejecting request")
+                raise SchedulerBusy(self.kind)
+            finally:
+                self.waiting -= 1
+
+        wait_time = time.monotonic() - start_time
+        self.wait_times.append(wait_time)
+        if wait_time > 1:
+            logger.info(f"AI request '{self.kind}' waited {wait_time:.2f} seconds in queue")
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def metrics(self) -> Dict:
+        waits = sorted(self.wait_times)
+
+        def percentile(p: float) -> float:
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(len(waits) * p))]
+
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_p50": percentile(0.5),
+            "wait_p95": percentile(0.95),
+            "wait_max": waits[-1] if waits else 0.0,
+        }
+
+class AIScheduler:
+    """Separate concurrency limits and bounded queues for chat and image requests."""
+
+    def __init__(self, lanes: Dict[str, _Lane]):
+        self._lanes = lanes
+
+    def slot(self, kind: str):
+        """Async context manager that holds a slot of the given kind."""
+        return self._lanes[kind].slot()
+
+    async def run(self, kind: str, coro_factory):
+        """Run coro_factory() once a slot of the given kind is available."""
+        async with self.slot(kind):
+            return await coro_factory()
+
+    def get_metrics(self) -> Dict[str, Dict]:
+        return {kind: lane.metrics() for kind, lane in self._lanes.items()}
+
+def _lane_from_env(kind: str, concurrency: int, max_queue: int) -> _Lane:
+    prefix = f"AI_{kind.upper()}"
+    return _Lane(
+        kind,
+        concurrency=int(os.environ.get(f"{prefix}_CONCURRENCY", concurrency)),
+        max_queue=int(os.environ.get(f"{prefix}_QUEUE", max_queue)),
+        queue_timeout=float(os.environ.get("AI_QUEUE_TIMEOUT", "30")),
+    )
+
+scheduler = AIScheduler({
+    'chat': _lane_from_env('chat', concurrency=4, max_queue=20),
+    'image': _lane_from_env('image', concurrency=1, max_queue=5),
+})
@@ -1,66 +1,90 @@
+import asyncio
+import html
 import logging
-import json
 import os
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import ContextTypes
-from content.lessons import LESSONS
-from content.quizzes import QUIZZES
-from bot.keyboard import get_main_keyboard, get_lesson_keyboard, get_history_keyboard
+from content.store import content_store
+from bot.keyboard import get_main_keyboard, get_lesson_keyboard, get_history_keyboard, get_stats_page_keyboard
 from utils.db_utils import (
-    get_or_create_user, update_progress, get_user_progress,
-    update_user_lesson, get_user_statistics, get_all_users_statistics
+    get_or_create_user, get_user_progress, complete_quiz_and_advance,
+    get_user_statistics, get_users_statistics_page, get_dashboard_stats,
+    get_user_cache_stats, sync_content
 )
-from bot.ai_helper import get_ml_explanation, analyze_ml_question, generate_ml_meme, get_random_ml_history
+from bot.ai_helper import get_ml_explanation, analyze_ml_question, stream_ml_explanation, stream_ml_question
+from bot.ai_scheduler import scheduler, SchedulerBusy
+from bot.history_pool import take_history_item
+from bot.streaming import STREAMING_ENABLED, MAX_MESSAGE_LENGTH, reply_streaming
+from bot.meme_store import find_stored_meme, create_meme, load_photo, remember_sent_meme
+from bot.activity import activity_buffer
+from bot.render import render_cache
 import time
-import asyncio
+from datetime import datetime
 from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
-# Add this at the top of the file
-_LESSONS_CACHE = {}
-_QUIZZES_CACHE = {}
+BUSY_MESSAGE = (
+    "⏳ Сейчас слишком много запросов к AI. "
+    "Пожалуйста, попробуйте через минуту."
+)
+
+CONTENT_WATCH_INTERVAL = int(os.environ.get("CONTENT_WATCH_INTERVAL", "30"))  # seconds, 0 - disabled
 
-def _init_caches():
-    """Initialize caches for lessons and quizzes"""
-    global _LESSONS_CACHE, _QUIZZES_CACHE
-    _LESSONS_CACHE.clear()
-    _QUIZZES_CACHE.clear()
-    _LESSONS_CACHE.update(LESSONS)
-    _QUIZZES_CACHE.update(QUIZZES)
-    logger.info(f"Caches initialized: {len(_LESSONS_CACHE)} lessons, {len(_QUIZZES_CACHE)} quizzes")
+def _render_content(store):
+    """Render lesson and quiz messages for the currently loaded content"""
+    # Готовые тексты сообщений собираем один раз, обработчики только отправляют их
+    render_cache.compile(store.lessons(), store.quizzes())
 
-# Initialize caches
-_init_caches()
+def init_content():
+    """Load compiled content and keep rendered messages in sync with it"""
+    content_store.ensure_loaded()
+    content_store.add_listener(_render_content)
+    logger.info(f"Content initialized: {content_store.lesson_count()} lessons, {len(content_store.quiz_ids())} quizzes")
 
-@lru_cache(maxsize=100)
 def get_cached_lesson(lesson_id: int):
-    """Get lesson from cache with improved error handling"""
+    """Get lesson from the content store with improved error handling"""
     try:
-        lesson = _LESSONS_CACHE.get(lesson_id)
+        lesson = content_store.lesson(lesson_id)
         if lesson:
-            logger.debug(f"Cache hit for lesson {lesson_id}")
             return lesson
-        logger.warning(f"Lesson {lesson_id} not found in cache")
+        logger.warning(f"Lesson {lesson_id} not found in content store")
         return None
     except Exception as e:
-        logger.error(f"Error getting cached lesson {lesson_id}: {str(e)}")
+        logger.error(f"Error getting lesson {lesson_id}: {str(e)}")
         return None
 
-@lru_cache(maxsize=100)
 def get_cached_quiz(quiz_id: int):
-    """Get quiz from cache with improved error handling"""
+    """Get quiz from the content store with improved error handling"""
     try:
-        quiz = _QUIZZES_CACHE.get(quiz_id)
+        quiz = content_store.quiz(quiz_id)
         if quiz:
-            logger.debug(f"Cache hit for quiz {quiz_id}")
             return quiz
-        logger.warning(f"Quiz {quiz_id} not found in cache")
+        logger.warning(f"Quiz {quiz_id} not found in content store")
         return None
     except Exception as e:
-        logger.error(f"Error getting cached quiz {quiz_id}: {str(e)}")
+        logger.error(f"Error getting quiz {quiz_id}: {str(e)}")
         return None
 
+async def watch_content(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновая проверка: подхватить измененный контент без перезапуска."""
+    if not content_store.reload():
+        return
+    # Новые уроки должны попасть в БД до первой попытки, иначе lesson_attempts
+    # нарушит внешний ключ. Upsert идемпотентен, поэтому его может выполнить каждый процесс
+    synced = await asyncio.to_thread(sync_content, content_store.lessons(), content_store.quizzes())
+    if synced is None:
+        logger.error("Content reloaded but not synced to the database")
+
+async def _reply_pages(update: Update, pages, reply_markup=None):
+    """Отправить заранее подготовленные части сообщения, клавиатура - у последней."""
+    for index, page in enumerate(pages):
+        await update.message.reply_text(
+            page,
+            reply_markup=reply_markup if index == len(pages) - 1 else None,
+            parse_mode='HTML'
+        )
+
 @lru_cache(maxsize=100)
 def normalize_button_text(text: str) -> str:
     """Нормализует текст кнопки для сравнения."""
@@ -76,8 +100,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Асинхронно получаем или создаем пользователя
-        user = await asyncio.to_thread(
-            get_or_create_user,
+        user = await get_or_create_user(
             telegram_id=update.effective_user.id,
             username=update.effective_user.username
         )
@@ -91,6 +114,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
+        activity_buffer.record(user.id)
+
         # Создаем клавиатуру заранее
         keyboard = get_main_keyboard()
         logger.debug("Created main keyboard")
@@ -159,8 +184,7 @@ async def handle_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Starting handle_lesson for user {update.effective_user.id}")
 
     try:
-        user = await asyncio.to_thread(
-            get_or_create_user,
+        user = await get_or_create_user(
             telegram_id=update.effective_user.id
         )
         if not user:
@@ -171,11 +195,14 @@ async def handle_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
+        activity_buffer.record(user.id)
+
         lesson = get_cached_lesson(user.current_lesson)
+        lesson_pages = render_cache.lesson(user.current_lesson)
         logger.debug(f"Retrieved lesson data for lesson_id {user.current_lesson}: {bool(lesson)}")
 
-        if not lesson:
-            if user.current_lesson > len(_LESSONS_CACHE):
+        if not lesson or not lesson_pages:
+            if user.current_lesson > content_store.lesson_count():
                 await update.message.reply_text(
                     "🎉 Поздравляем! Вы прошли все уроки!",
                     parse_mode='HTML'
@@ -188,48 +215,22 @@ async def handle_lesson(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             return
 
-        try:
-            lesson_message = (
-                f"📖 Урок {user.current_lesson}: {lesson['title']}\n\n"
-                f"{lesson['content']}\n\n"
-                f"❓ Проверочный вопрос:\n"
-                f"{lesson['check_question']}\n\n"
-            )
-
-            # Добавляем варианты ответов
-            for option in lesson['check_options']:
-                lesson_message += f"{option}\n"
-
-            lesson_message += "\n📚 Дополнительные материалы:\n"
-            for material in lesson['materials']:
-                lesson_message += f"{material}\n"
+        # Сохраняем информацию о текущем вопросе в контексте
+        context.user_data['current_check'] = {
+            'lesson_id': user.current_lesson,
+            'correct_answer': lesson['check_correct']
+        }
 
-            # Сохраняем информацию о текущем вопросе в контексте
-            context.user_data['current_check'] = {
+        # Время начала урока держим в памяти, в БД попытка пишется один раз при сдаче теста
+        lesson_started = context.user_data.get('lesson_started')
+        if not lesson_started or lesson_started['lesson_id'] != user.current_lesson:
+            context.user_data['lesson_started'] = {
                 'lesson_id': user.current_lesson,
-                'correct_answer': lesson['check_correct']
+                'started_at': time.time()
             }
 
-            keyboard = get_lesson_keyboard()
-            await update.message.reply_text(
-                lesson_message,
-                reply_markup=keyboard,
-                parse_mode='HTML'
-            )
-            logger.info(f"Successfully sent lesson {user.current_lesson} to user {update.effective_user.id}")
-
-        except KeyError as ke:
-            logger.error(f"Missing key in lesson data: {ke}")
-            await update.message.reply_text(
-                "Извините, в данных урока обнаружена ошибка. Мы уже работаем над её исправлением.",
-                parse_mode='HTML'
-            )
-        except Exception as e:
-            logger.error(f"Error formatting lesson message: {str(e)}")
-            await update.message.reply_text(
-                "Произошла ошибка при подготовке урока. Попробуйте позже.",
-                parse_mode='HTML'
-            )
+        await _reply_pages(update, lesson_pages, reply_markup=get_lesson_keyboard())
+        logger.info(f"Successfully sent lesson {user.current_lesson} to user {update.effective_user.id}")
 
     except Exception as e:
         logger.error(f"Error in handle_lesson: {str(e)}", exc_info=True)
@@ -245,16 +246,18 @@ async def handle_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Оптимизированный обработчик тестов."""
     start_time = time.time()
 
-    user = await asyncio.to_thread(
-        get_or_create_user,
+    user = await get_or_create_user(
         telegram_id=update.effective_user.id
     )
     if not user:
         await update.message.reply_text("Произошла ошибка. Попробуйте позже.")
         return
 
+    activity_buffer.record(user.id)
+
     quiz = get_cached_quiz(user.current_lesson)
-    if not quiz:
+    quiz_pages = render_cache.quiz(user.current_lesson)
+    if not quiz or not quiz_pages:
         await update.message.reply_text("Нет доступных тестов.")
         return
 
@@ -267,10 +270,7 @@ async def handle_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     logger.info(f"Setting quiz for user {user.id}, lesson {user.current_lesson}")
 
-    await update.message.reply_text(
-        f"❓ Тест по теме {quiz['title']}\n\n{quiz['question']}",
-        parse_mode='HTML'
-    )
+    await _reply_pages(update, quiz_pages)
     logger.info(f"Quiz handling took {time.time() - start_time:.2f} seconds")
 
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -306,8 +306,7 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Если не кнопка, обрабатываем как ответ на вопрос
-        user = await asyncio.to_thread(
-            get_or_create_user,
+        user = await get_or_create_user(
             telegram_id=update.effective_user.id
         )
         if not user:
@@ -319,6 +318,8 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
+        activity_buffer.record(user.id)
+
         answer = update.message.text.upper()
         logger.debug(f"Received answer: {answer} from user {update.effective_user.id}")
 
@@ -366,89 +367,58 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.info(f"Correct answer for check question, lesson {current_check['lesson_id']}")
                 context.user_data.pop('current_check', None)
             else:
-                lesson = get_cached_lesson(current_check['lesson_id'])
-                if lesson:
-                    hint_message = (
-                        "❌ Неправильно. Попробуйте еще раз.\n"
-                        "Подсказка: внимательно прочитайте материал урока\n\n"
-                        f"Вопрос: {lesson['check_question']}\n"
-                    )
-                    for option in lesson['check_options']:
-                        hint_message += f"{option}\n"
-
-                    await update.message.reply_text(
-                        hint_message,
-                        reply_markup=get_lesson_keyboard(),
-                        parse_mode='HTML'
-                    )
-                else:
-                    await update.message.reply_text(
-                        "❌ Неправильно. Попробуйте еще раз.",
-                        reply_markup=get_lesson_keyboard(),
-                        parse_mode='HTML'
-                    )
+                await _reply_pages(
+                    update,
+                    render_cache.check_hint(current_check['lesson_id']),
+                    reply_markup=get_lesson_keyboard()
+                )
                 logger.info(f"Incorrect answer for check question from user {user.id}")
             return
 
         if current_quiz:
             logger.info(f"Processing quiz answer for quiz {current_quiz['quiz_id']}")
             if answer == current_quiz['correct_answer']:
-                # Асинхронно обновляем прогресс
-                success = await asyncio.to_thread(
-                    update_progress,
+                next_lesson = current_quiz['quiz_id'] + 1
+                lesson_started = context.user_data.get('lesson_started')
+                started_at = None
+                if lesson_started and lesson_started['lesson_id'] == current_quiz['quiz_id']:
+                    started_at = datetime.utcfromtimestamp(lesson_started['started_at'])
+
+                # Сохраняем результат теста и переводим на следующий урок одной транзакцией
+                completed = await complete_quiz_and_advance(
                     user.id,
                     current_quiz['quiz_id'],
-                    100
+                    100,
+                    next_lesson,
+                    started_at=started_at
                 )
 
-                if success:
-                    logger.info(f"Progress updated for user {user.id}, lesson {current_quiz['quiz_id']}")
-                    next_lesson = current_quiz['quiz_id'] + 1
-
-                    # Обновляем урок пользователя
-                    lesson_updated = await asyncio.to_thread(
-                        update_user_lesson,
-                        user.id,
-                        next_lesson
+                if completed:
+                    context.user_data.pop('current_quiz', None)
+                    context.user_data.pop('lesson_started', None)
+                    await update.message.reply_text(
+                        "✅ Правильно! Можете переходить к следующему уроку.\n"
+                        "Используйте /lesson для просмотра следующего урока.",
+                        reply_markup=get_main_keyboard(),
+                        parse_mode='HTML'
                     )
+                    logger.info(f"User {user.id} moved to next lesson {next_lesson}")
+                    return
 
-                    if lesson_updated:
-                        context.user_data.pop('current_quiz', None)
-                        await update.message.reply_text(
-                            "✅ Правильно! Можете переходить к следующему уроку.\n"
-                            "Используйте /lesson для просмотра следующего урока.",
-                            reply_markup=get_main_keyboard(),
-                            parse_mode='HTML'
-                        )
-                        logger.info(f"User {user.id} moved to next lesson {next_lesson}")
-                        return
-                    else:
-                        logger.error(f"Failed to update user {user.id} to lesson {next_lesson}")
-                else:
-                    logger.error(f"Failed to update progress for user {user.id}")
-
+                logger.error(f"Failed to complete quiz {current_quiz['quiz_id']} for user {user.id}")
                 await update.message.reply_text(
                     "Произошла ошибка при сохранении прогресса. Попробуйте позже.",
                     reply_markup=get_main_keyboard(),
                     parse_mode='HTML'
                 )
             else:
-                quiz = get_cached_quiz(current_quiz['quiz_id'])
-                if quiz:
-                    await update.message.reply_text(
-                        f"❌ Неправильно. Попробуйте еще раз.\n\n"
-                        f"Вопрос: {quiz['question']}\n"
-                        "Подсказка: правильный ответ должен быть одной буквой (A, B или C)",
-                        reply_markup=get_main_keyboard(),
-                        parse_mode='HTML'
-                    )
-                else:
-                    await update.message.reply_text(
-                        "❌ Неправильно. Попробуйте еще раз.\n"
-                        "Подсказка: правильный ответ должен быть одной буквой (A, B или C)",
-                        reply_markup=get_main_keyboard(),
-                        parse_mode='HTML'
-                    )
+                # Неверный ответ - неудачная попытка урока, пишется в БД пакетом
+                activity_buffer.record_wrong_answer(user.id, current_quiz['quiz_id'])
+                await _reply_pages(
+                    update,
+                    render_cache.quiz_hint(current_quiz['quiz_id']),
+                    reply_markup=get_main_keyboard()
+                )
                 logger.info(f"Incorrect quiz answer from user {user.id}")
 
     except Exception as e:
@@ -468,8 +438,7 @@ async def handle_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Starting handle_progress for user {update.effective_user.id}")
 
     try:
-        user = await asyncio.to_thread(
-            get_or_create_user,
+        user = await get_or_create_user(
             telegram_id=update.effective_user.id
         )
         if not user:
@@ -480,19 +449,21 @@ async def handle_progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        progress = await asyncio.to_thread(get_user_progress, user.id)
+        activity_buffer.record(user.id)
+
+        progress = await get_user_progress(user.id)
         logger.debug(f"Retrieved progress data for user {user.id}: {bool(progress)}")
 
         # Получаем общее количество уроков из кэша
-        total_lessons = len(_LESSONS_CACHE)
-        completed_lessons = len([p for p in progress if p.completed]) if progress else 0
+        total_lessons = content_store.lesson_count()
+        completed_lessons = progress.completed_lessons if progress else 0
         completion_percentage = (completed_lessons / total_lessons) * 100 if total_lessons > 0 else 0
 
         # Создаем визуальный индикатор прогресса
         progress_bar = "▓" * int(completion_percentage / 10) + "░" * (10 - int(completion_percentage / 10))
 
-        if progress:
-            avg_score = sum(p.quiz_score for p in progress) / len(progress)
+        if progress and progress.count:
+            avg_score = progress.average_score
             progress_text = (
                 f"📊 Ваш прогресс:\n\n"
                 f"Прогресс курса: [{progress_bar}] {completion_percentage:.1f}%\n\n"
@@ -540,8 +511,15 @@ async def handle_explain(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     topic = " ".join(context.args)
-    explanation = get_ml_explanation(topic)
-    await update.message.reply_text(explanation, parse_mode='HTML')
+    try:
+        if STREAMING_ENABLED:
+            explanation = await reply_streaming(update, stream_ml_explanation(topic))
+        else:
+            explanation = await get_ml_explanation(topic)
+            await update.message.reply_text(explanation, parse_mode='HTML')
+    except SchedulerBusy:
+        await update.message.reply_text(BUSY_MESSAGE, parse_mode='HTML')
+        return
 
     if "❓" in explanation:
         context.user_data['last_explanation'] = topic
@@ -551,48 +529,38 @@ async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the /history command to show random ML history facts."""
     logger.info(f"Starting handle_history for user {update.effective_user.id}")
     try:
-        await update.message.reply_text(
-            "🕒 Генерирую историческую справку...",
-            parse_mode='HTML'
-        )
-
-        history_data = get_random_ml_history()
-        logger.debug(f"Got history data: {bool(history_data)}")
-
-        try:
-            data = history_data if isinstance(history_data, dict) else json.loads(history_data)
-
-            if not all(key in data for key in ['history', 'question', 'correct_answer', 'explanation']):
-                raise ValueError("Missing required fields in history data")
-
-            context.user_data['current_history_test'] = {
-                'correct_answer': data['correct_answer'],
-                'explanation': data['explanation']
-            }
-
-            keyboard = get_history_keyboard()
-
-            message = (
-                f"📚 {data['history']}\n\n"
-                f"❓ Тест на понимание:\n{data['question']}\n\n"
-                "Выберите ответ (A, B или C):"
-            )
-
-            await update.message.reply_text(
-                message,
-                reply_markup=keyboard,
-                parse_mode='HTML'
-            )
-            logger.info(f"Successfully sent history to user {update.effective_user.id}")
+        # Справки заранее генерируются фоновой задачей, здесь только берем готовую
+        data = await take_history_item(context)
+        logger.debug(f"Got history data: {bool(data)}")
 
-        except (json.JSONDecodeError, ValueError, KeyError) as e:
-            logger.error(f"Error processing history data: {str(e)}")
+        if not data:
             await update.message.reply_text(
-                "😔 Извините, произошла ошибка при обработке исторической справки.\n"
-                "Попробуйте еще раз, используя команду /history",
+                "🕒 Исторические справки сейчас готовятся.\n"
+                "Попробуйте через минуту, используя команду /history",
                 reply_markup=get_main_keyboard(),
                 parse_mode='HTML'
             )
+            return
+
+        context.user_data['current_history_test'] = {
+            'correct_answer': data['correct_answer'],
+            'explanation': data['explanation']
+        }
+
+        keyboard = get_history_keyboard()
+
+        message = (
+            f"📚 {data['history']}\n\n"
+            f"❓ Тест на понимание:\n{data['question']}\n\n"
+            "Выберите ответ (A, B или C):"
+        )
+
+        await update.message.reply_text(
+            message,
+            reply_markup=keyboard,
+            parse_mode='HTML'
+        )
+        logger.info(f"Successfully sent history to user {update.effective_user.id}")
 
     except Exception as e:
         logger.error(f"Error in handle_history: {str(e)}", exc_info=True)
@@ -611,8 +579,14 @@ async def handle_ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     question = " ".join(context.args)
-    answer = analyze_ml_question(question)
-    await update.message.reply_text(answer, parse_mode='HTML')
+    try:
+        if STREAMING_ENABLED:
+            await reply_streaming(update, stream_ml_question(question))
+        else:
+            answer = await analyze_ml_question(question)
+            await update.message.reply_text(answer, parse_mode='HTML')
+    except SchedulerBusy:
+        await update.message.reply_text(BUSY_MESSAGE, parse_mode='HTML')
 
 
 async def handle_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -638,23 +612,27 @@ async def handle_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-    await update.message.reply_text(
-        "🎨 Генерирую мем" + (f" про {concept}" if concept else "") + "...\n"
-        "Это может занять несколько секунд.",
-        parse_mode='HTML'
-    )
-
     try:
-        meme_url = generate_ml_meme(concept)
-        if meme_url:
-            await update.message.reply_photo(
-                photo=meme_url,
+        # Если для темы уже накоплено несколько вариантов, отправляем сохраненный
+        asset = await find_stored_meme(concept)
+        if not asset:
+            await update.message.reply_text(
+                "🎨 Генерирую мем" + (f" про {concept}" if concept else "") + "...\n"
+                "Это может занять несколько секунд.",
+                parse_mode='HTML'
+            )
+            asset = await create_meme(concept)
+
+        if asset:
+            message = await update.message.reply_photo(
+                photo=await load_photo(asset),
                 caption="🤖 Ваш мем о машинном обучении!" + 
                        (f"\nТема: {concept}" if concept else "") +
                        "\n\n💡 Используйте команду /meme [тема] для генерации мема на конкретную тему" +
                        "\n❓ Есть вопросы? Обращайтесь к @raddayurieva",
                 parse_mode='HTML'
             )
+            await remember_sent_meme(asset, message)
         else:
             await update.message.reply_text(
                 "😔 Извините, не удалось сгенерировать мем. " +
@@ -664,6 +642,8 @@ async def handle_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Обращайтесь к @raddayurieva",
                 parse_mode='HTML'
             )
+    except SchedulerBusy:
+        await update.message.reply_text(BUSY_MESSAGE, parse_mode='HTML')
     except Exception as e:
         logger.error(f"Error in handle_meme: {str(e)}")
         await update.message.reply_text(
@@ -674,6 +654,55 @@ async def handle_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+STATS_PAGE_SIZE = 20  # записей, запрашиваемых на одну страницу /stats
+STATS_HEADER = "📊 Статистика пользователей:\n\n"
+
+def _format_user_stat(user_stat) -> str:
+    last_activity = user_stat['last_activity']
+    return (
+        f"👤 Пользователь: {html.escape(user_stat['username'] or str(user_stat['telegram_id']))}\n"
+        f"📚 Текущий урок: {user_stat['current_lesson']}\n"
+        f"✅ Завершено уроков: {user_stat['completed_lessons']}\n"
+        f"📝 Средний балл: {user_stat['average_score'] or 0:.1f}\n"
+        f"🔄 Всего попыток: {user_stat['total_attempts']}\n"
+        f"⏰ Последняя активность: {last_activity.strftime('%Y-%m-%d %H:%M') if last_activity else '-'}\n"
+        "-------------------\n"
+    )
+
+async def _build_stats_page(cursor: int, backward: bool = False):
+    """Собрать страницу статистики, которая целиком помещается в одно сообщение.
+
+    Возвращает текст и клавиатуру навигации или None, если записей нет.
+    """
+    rows = await get_users_statistics_page(cursor, STATS_PAGE_SIZE + 1, backward)
+    if not rows:
+        return None
+
+    has_more = len(rows) > STATS_PAGE_SIZE
+    if has_more:
+        # Лишняя запись нужна только чтобы узнать, есть ли еще страница
+        rows = rows[1:] if backward else rows[:-1]
+
+    # Страница обрывается только на границе записи
+    page = []
+    length = len(STATS_HEADER)
+    for row in (reversed(rows) if backward else rows):
+        entry = _format_user_stat(row)
+        if page and length + len(entry) > MAX_MESSAGE_LENGTH:
+            has_more = True
+            break
+        page.append((row['user_id'], entry))
+        length += len(entry)
+    if backward:
+        page.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor > 0, has_more
+
+    text = STATS_HEADER + "".join(entry for _, entry in page)
+    keyboard = get_stats_page_keyboard(page[0][0], page[-1][0], has_prev, has_next)
+    return text, keyboard
+
 async def handle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статистику для админа."""
     # Проверяем, является ли пользователь админом
@@ -685,36 +714,81 @@ async def handle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    all_stats = await asyncio.to_thread(get_all_users_statistics)
-
-    if not all_stats:
+    page = await _build_stats_page(0)
+    if not page:
         await update.message.reply_text(
             "📊 Статистика пока недоступна.",
             parse_mode='HTML'
         )
         return
 
-    # Формируем сообщение со статистикой
-    stats_message = "📊 Статистика пользователей:\n\n"
+    text, keyboard = page
+    await update.message.reply_text(text, parse_mode='HTML', reply_markup=keyboard)
 
-    for user_stat in all_stats:
-        stats_message += (
-            f"👤 Пользователь: {user_stat['username']}\n"
-            f"📚 Текущий урок: {user_stat['current_lesson']}\n"
-            f"✅ Завершено уроков: {user_stat['completed_lessons']}\n"
-            f"📝 Средний балл: {user_stat['average_score']:.1f}\n"
-            f"🔄 Всего попыток: {user_stat['total_attempts']}\n"
-            f"⏰ Последняя активность: {user_stat['last_activity'].strftime('%Y-%m-%d %H:%M')}\n"
-            "-------------------\n"
+async def handle_stats_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переключить страницу статистики по кнопкам навигации."""
+    query = update.callback_query
+    ADMIN_ID = int(os.environ.get("ADMIN_TELEGRAM_ID", "0"))
+    if update.effective_user.id != ADMIN_ID:
+        await query.answer("❌ У вас нет доступа к этой команде.")
+        return
+
+    try:
+        _, direction, cursor = query.data.split(":")
+        cursor = int(cursor)
+    except ValueError:
+        await query.answer()
+        return
+
+    page = await _build_stats_page(cursor, backward=direction == "prev")
+    if not page:
+        await query.answer("Больше записей нет")
+        return
+
+    await query.answer()
+    text, keyboard = page
+    await query.edit_message_text(text, parse_mode='HTML', reply_markup=keyboard)
+
+async def handle_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать сводные показатели курса для админа."""
+    ADMIN_ID = int(os.environ.get("ADMIN_TELEGRAM_ID", "0"))
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text(
+            "❌ У вас нет доступа к этой команде.",
+            parse_mode='HTML'
         )
+        return
 
-    # Разбиваем на части, если сообщение слишком длинное
-    MAX_MESSAGE_LENGTH = 4096
-    for i in range(0, len(stats_message), MAX_MESSAGE_LENGTH):
+    stats = await get_dashboard_stats()
+    if not stats:
         await update.message.reply_text(
-            stats_message[i:i + MAX_MESSAGE_LENGTH],
+            "📊 Статистика пока недоступна.",
             parse_mode='HTML'
         )
+        return
+
+    total_users = stats['total_users']
+    median_score = f"{stats['median_score']:.1f}" if stats['median_score'] is not None else "-"
+    dashboard_message = (
+        "📈 <b>Сводка по курсу</b>\n\n"
+        f"👥 Всего пользователей: {total_users}\n"
+        f"🟢 Активны за сутки: {stats['active_day']}\n"
+        f"📅 Активны за неделю: {stats['active_week']}\n"
+        f"📝 Медианный балл: {median_score}\n\n"
+        "<b>Воронка по урокам</b> (дошли / завершили / застряли / попыток на завершение / средний балл)\n"
+    )
+
+    empty_lesson = {"reached": 0, "completed": 0, "stuck": 0, "avg_attempts": 0.0, "avg_score": 0.0}
+    for lesson_id in content_store.lesson_ids():
+        lesson = stats['lessons'].get(lesson_id, empty_lesson)
+        completed_share = lesson['completed'] / total_users * 100 if total_users else 0
+        dashboard_message += (
+            f"{lesson_id}. {lesson['reached']} / {lesson['completed']} ({completed_share:.0f}%) / "
+            f"{lesson['stuck']} / {lesson['avg_attempts']:.1f} / {lesson['avg_score']:.0f}\n"
+        )
+
+    dashboard_message += f"\n🕒 Данные на {stats['generated_at'].strftime('%Y-%m-%d %H:%M')} UTC"
+    await update.message.reply_text(dashboard_message, parse_mode='HTML')
 
 async def handle_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статистику для конкретного пользователя."""
@@ -738,7 +812,7 @@ async def handle_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         user_id = int(context.args[0])
-        stats = await asyncio.to_thread(get_user_statistics, user_id)
+        stats = await get_user_statistics(user_id)
 
         if not stats:
             await update.message.reply_text(
@@ -771,4 +845,68 @@ async def handle_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             "❌ Произошла ошибка при получении статистики.",
             parse_mode='HTML'
-        )
\ No newline at end of file
+        )
+
+async def handle_ai_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать метрики очередей AI запросов и кэша пользователей для админа."""
+    ADMIN_ID = int(os.environ.get("ADMIN_TELEGRAM_ID", "0"))
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text(
+            "❌ У вас нет доступа к этой команде.",
+            parse_mode='HTML'
+        )
+        return
+
+    stats_message = "🤖 Очереди AI запросов:\n\n"
+    for kind, metrics in scheduler.get_metrics().items():
+        stats_message += (
+            f"<b>{kind}</b>\n"
+            f"⚙️ Выполняется: {metrics['in_flight']}/{metrics['concurrency']}\n"
+            f"⏳ В очереди: {metrics['waiting']}/{metrics['max_queue']}\n"
+            f"✅ Выполнено: {metrics['completed']}\n"
+            f"🚫 Отклонено: {metrics['rejected']}\n"
+            f"🕒 Ожидание p50/p95/max: {metrics['wait_p50']:.2f}/"
+            f"{metrics['wait_p95']:.2f}/{metrics['wait_max']:.2f} сек\n\n"
+        )
+
+    cache_stats = get_user_cache_stats()
+    stats_message += (
+        "<b>Кэш пользователей</b>\n"
+        f"📦 Записей: {cache_stats['size']}/{cache_stats['maxsize']}\n"
+        f"🎯 Попаданий: {cache_stats['hits']} ({cache_stats['hit_rate']:.1f}%)\n"
+        f"❔ Промахов: {cache_stats['misses']}\n"
+        f"♻️ Вытеснено: {cache_stats['evictions']}\n"
+    )
+
+    await update.message.reply_text(stats_message, parse_mode='HTML')
+
+async def handle_reload_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пересобрать контент уроков и тестов без перезапуска бота."""
+    ADMIN_ID = int(os.environ.get("ADMIN_TELEGRAM_ID", "0"))
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text(
+            "❌ У вас нет доступа к этой команде.",
+            parse_mode='HTML'
+        )
+        return
+
+    if not content_store.reload(force=True):
+        await update.message.reply_text(
+            "❌ Не удалось обновить контент, бот продолжает работать со старой версией. Подробности в логах.",
+            parse_mode='HTML'
+        )
+        return
+
+    # Копию контента в БД обновляем только для изменившихся уроков и тестов
+    synced = await asyncio.to_thread(sync_content, content_store.lessons(), content_store.quizzes())
+    sync_message = (
+        f"В БД обновлено: уроков {synced[0]}, тестов {synced[1]}"
+        if synced else "⚠️ Не удалось обновить контент в БД"
+    )
+
+    # Остальные процессы подхватят новый файл при следующей проверке
+    await update.message.reply_text(
+        f"✅ Контент обновлен: уроков {content_store.lesson_count()}, тестов {len(content_store.quiz_ids())}\n"
+        f"{sync_message}",
+        parse_mode='HTML'
+    )
@@ -0,0 +1,66 @@
+import os
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Dict, Optional
+from telegram.ext import ContextTypes
+from bot.ai_helper import generate_ml_history_item
+from utils.db_utils import count_history_items, add_history_items, pop_history_item
+from utils.text_normalize import normalize_query
+
+logger = logging.getLogger(__name__)
+
+LOW_WATERMARK = int(os.environ.get("HISTORY_POOL_LOW_WATERMARK", "5"))
+HIGH_WATERMARK = int(os.environ.get("HISTORY_POOL_HIGH_WATERMARK", "20"))
+REFILL_INTERVAL = int(os.environ.get("HISTORY_POOL_REFILL_INTERVAL", "300"))  # seconds
+REFILL_CONCURRENCY = 2  # одновременных запросов при пополнении
+
+_refill_lock = asyncio.Lock()
+
+def make_content_hash(item: Dict) -> str:
+    return hashlib.sha256(normalize_query(item['history']).encode("utf-8")).hexdigest()
+
+async def refill_history_pool(context: Optional[ContextTypes.DEFAULT_TYPE] = None):
+    """Job callback: top the pool up to the high watermark once it drops below the low one."""
+    if _refill_lock.locked():
+        return
+
+    async with _refill_lock:
+        start_time = time.time()
+        available = await count_history_items()
+        if available >= LOW_WATERMARK:
+            return
+
+        needed = HIGH_WATERMARK - available
+        logger.info(f"History pool has {available} items, generating {needed} more")
+
+        added = 0
+        attempts = 0
+        while added < needed and attempts < needed * 2:
+            batch = min(REFILL_CONCURRENCY, needed - added)
+            attempts += batch
+            results = await asyncio.gather(
+                *[generate_ml_history_item() for _ in range(batch)],
+                return_exceptions=True
+            )
+            items = []
+            for result in results:
+                if isinstance(result, dict):
+                    result['content_hash'] = make_content_hash(result)
+                    items.append(result)
+            added += await add_history_items(items)
+
+        logger.info(f"History pool refill added {added} items in {time.time() - start_time:.2f} seconds")
+
+def schedule_refill(context: ContextTypes.DEFAULT_TYPE):
+    """Ask the job queue to refill the pool as soon as possible."""
+    if context.job_queue:
+        context.job_queue.run_once(refill_history_pool, when=0, name="history_pool_refill")
+
+async def take_history_item(context: ContextTypes.DEFAULT_TYPE) -> Optional[Dict]:
+    """Pop a ready history item and trigger a refill when the pool runs low."""
+    item, remaining = await pop_history_item()
+    if remaining < LOW_WATERMARK:
+        schedule_refill(context)
+    return item
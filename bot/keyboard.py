@@ -1,4 +1,4 @@
-from telegram import ReplyKeyboardMarkup
+from telegram import ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 
 def get_main_keyboard():
     """
@@ -45,4 +45,15 @@ def get_history_keyboard():
         resize_keyboard=True,
         one_time_keyboard=False,
         input_field_placeholder="Выберите действие"
-    )
\ No newline at end of file
+    )
+
+def get_stats_page_keyboard(first_id: int, last_id: int, has_prev: bool, has_next: bool):
+    """
+    Создает кнопки навигации по страницам статистики
+    """
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"stats:prev:{first_id}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"stats:next:{last_id}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
@@ -0,0 +1,96 @@
+import os
+import asyncio
+import logging
+import random
+import uuid
+from typing import Dict, Optional
+import httpx
+from bot.ai_helper import generate_ml_meme, TIMEOUT
+from utils.db_utils import get_meme_assets, add_meme_asset, touch_meme_asset, evict_meme_files
+from utils.text_normalize import normalize_query
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = os.environ.get("MEME_STORE_DIR", "meme_cache")
+VARIANTS_PER_CONCEPT = int(os.environ.get("MEME_VARIANTS", "3"))
+MAX_STORE_BYTES = int(os.environ.get("MEME_STORE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+def make_concept_key(concept: Optional[str]) -> str:
+    return normalize_query(concept) if concept else ""
+
+async def find_stored_meme(concept: Optional[str]) -> Optional[Dict]:
+    """Return a stored variant once the concept already has a full pool of them."""
+    assets = await get_meme_assets(make_concept_key(concept))
+    if len(assets) < VARIANTS_PER_CONCEPT:
+        return None
+    return random.choice(assets)
+
+async def _download(url: str) -> bytes:
+    async with httpx.AsyncClient(timeout=TIMEOUT) as http_client:
+        response = await http_client.get(url)
+        response.raise_for_status()
+        return response.content
+
+def _write_file(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _remove_files(paths) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Failed to remove meme file {path}: {str(e)}")
+
+async def create_meme(concept: Optional[str]) -> Optional[Dict]:
+    """Generate a new variant, download it once and keep it on disk.
+
+    Falls back to an already stored variant if generation fails.
+    """
+    concept_key = make_concept_key(concept)
+    meme_url = await generate_ml_meme(concept)
+    if not meme_url:
+        assets = await get_meme_assets(concept_key)
+        return random.choice(assets) if assets else None
+
+    try:
+        data = await _download(meme_url)
+    except httpx.HTTPError as e:
+        logger.error(f"Failed to download generated meme: {str(e)}")
+        return None
+
+    path = os.path.join(STORE_DIR, f"{uuid.uuid4().hex}.png")
+    await asyncio.to_thread(_write_file, path, data)
+    asset = await add_meme_asset(concept_key, path, len(data))
+
+    evicted = await evict_meme_files(MAX_STORE_BYTES)
+    if evicted:
+        await asyncio.to_thread(_remove_files, evicted)
+        if path in evicted:
+            # Новый файл не поместился в лимит, отправляем его из памяти
+            asset = None
+    return asset or {"id": None, "file_path": None, "telegram_file_id": None, "data": data}
+
+async def load_photo(asset: Dict):
+    """Return what to pass as photo: a Telegram file_id or the image bytes."""
+    if asset.get("telegram_file_id"):
+        return asset["telegram_file_id"]
+    if asset.get("data"):
+        return asset["data"]
+    return await asyncio.to_thread(_read_file, asset["file_path"])
+
+async def remember_sent_meme(asset: Dict, message) -> None:
+    """Update LRU order and keep the file_id Telegram assigned on the first upload."""
+    if not asset.get("id"):
+        return
+    file_id = None
+    if not asset.get("telegram_file_id") and message and message.photo:
+        file_id = message.photo[-1].file_id
+    await touch_meme_asset(asset["id"], file_id)
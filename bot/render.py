@@ -0,0 +1,103 @@
+import logging
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+QUIZ_HINT = "Подсказка: правильный ответ должен быть одной буквой (A, B или C)"
+CHECK_WRONG = "❌ Неправильно. Попробуйте еще раз."
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> Tuple[str, ...]:
+    """Split text into Telegram-sized parts on paragraph, then line boundaries."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            # Строка длиннее лимита, режем по последнему пробелу
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip("\n ")
+    if text.strip() or not parts:
+        parts.append(text)
+    return tuple(parts)
+
+def render_lesson(lesson_id: int, lesson: Dict) -> str:
+    lesson_message = (
+        f"📖 Урок {lesson_id}: {lesson['title']}\n\n"
+        f"{lesson['content']}\n\n"
+        f"❓ Проверочный вопрос:\n"
+        f"{lesson['check_question']}\n\n"
+    )
+    lesson_message += "".join(f"{option}\n" for option in lesson['check_options'])
+    lesson_message += "\n📚 Дополнительные материалы:\n"
+    lesson_message += "".join(f"{material}\n" for material in lesson['materials'])
+    return lesson_message
+
+def render_check_hint(lesson: Dict) -> str:
+    hint_message = (
+        f"{CHECK_WRONG}\n"
+        "Подсказка: внимательно прочитайте материал урока\n\n"
+        f"Вопрос: {lesson['check_question']}\n"
+    )
+    return hint_message + "".join(f"{option}\n" for option in lesson['check_options'])
+
+def render_quiz(quiz: Dict) -> str:
+    return f"❓ Тест по теме {quiz['title']}\n\n{quiz['question']}"
+
+def render_quiz_hint(quiz: Dict) -> str:
+    return (
+        f"{CHECK_WRONG}\n\n"
+        f"Вопрос: {quiz['question']}\n"
+        f"{QUIZ_HINT}"
+    )
+
+class RenderCache:
+    """Lesson, quiz and hint messages rendered once and already split for Telegram.
+
+    compile() builds new tables and swaps them in, so handlers never see a
+    half-built state during a content reload.
+    """
+
+    def __init__(self):
+        self._lessons: Dict[int, Tuple[str, ...]] = {}
+        self._check_hints: Dict[int, Tuple[str, ...]] = {}
+        self._quizzes: Dict[int, Tuple[str, ...]] = {}
+        self._quiz_hints: Dict[int, Tuple[str, ...]] = {}
+
+    def compile(self, lessons: Dict[int, Dict], quizzes: Dict[int, Dict]) -> None:
+        compiled_lessons, check_hints, compiled_quizzes, quiz_hints = {}, {}, {}, {}
+        for lesson_id, lesson in lessons.items():
+            try:
+                compiled_lessons[lesson_id] = split_message(render_lesson(lesson_id, lesson))
+                check_hints[lesson_id] = split_message(render_check_hint(lesson))
+            except KeyError as e:
+                logger.error(f"Missing key {e} in lesson {lesson_id}, lesson is not rendered")
+        for quiz_id, quiz in quizzes.items():
+            try:
+                compiled_quizzes[quiz_id] = split_message(render_quiz(quiz))
+                quiz_hints[quiz_id] = split_message(render_quiz_hint(quiz))
+            except KeyError as e:
+                logger.error(f"Missing key {e} in quiz {quiz_id}, quiz is not rendered")
+
+        self._lessons, self._check_hints = compiled_lessons, check_hints
+        self._quizzes, self._quiz_hints = compiled_quizzes, quiz_hints
+        logger.info(f"Rendered {len(compiled_lessons)} lessons and {len(compiled_quizzes)} quizzes")
+
+    def lesson(self, lesson_id: int) -> Optional[Tuple[str, ...]]:
+        return self._lessons.get(lesson_id)
+
+    def check_hint(self, lesson_id: int) -> Tuple[str, ...]:
+        return self._check_hints.get(lesson_id, (CHECK_WRONG,))
+
+    def quiz(self, quiz_id: int) -> Optional[Tuple[str, ...]]:
+        return self._quizzes.get(quiz_id)
+
+    def quiz_hint(self, quiz_id: int) -> Tuple[str, ...]:
+        return self._quiz_hints.get(quiz_id, (f"{CHECK_WRONG}\n{QUIZ_HINT}",))
+
+render_cache = RenderCache()
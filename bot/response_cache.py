@@ -0,0 +1,142 @@
+import os
+import hashlib
+import logging
+from typing import List, Optional
+from utils.cache import TTLCache
+from utils.db_utils import (
+    get_cached_response, store_cached_response, prune_cached_responses, get_cached_prompts
+)
+from utils.text_normalize import normalize_query
+from utils import similarity
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = int(os.environ.get("AI_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+MEMORY_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", "500"))
+DB_CACHE_MAX_ENTRIES = int(os.environ.get("AI_CACHE_DB_MAX_ENTRIES", "5000"))
+PRUNE_EVERY = 100  # чистим таблицу кэша раз в N записей
+SEMANTIC_ENABLED = os.environ.get("AI_CACHE_SEMANTIC", "1") == "1"
+SIMILARITY_THRESHOLD = float(os.environ.get("AI_CACHE_SIMILARITY", "0.85"))
+SIMILARITY_MAX_ENTRIES = int(os.environ.get("AI_CACHE_SIMILARITY_SIZE", "1000"))
+
+def make_cache_key(kind: str, key: str) -> str:
+    return hashlib.sha256(f"{kind}:{key}".encode("utf-8")).hexdigest()
+
+class MemoryResponseCache:
+    """Per-process LRU tier with TTL."""
+
+    def __init__(self, maxsize: int, ttl: int):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, kind: str, key: str) -> Optional[str]:
+        return self._cache.get((kind, key))
+
+    async def set(self, kind: str, key: str, value: str) -> None:
+        self._cache.set((kind, key), value)
+
+    def stats(self):
+        return self._cache.stats()
+
+class DatabaseResponseCache:
+    """Persistent tier stored in the ai_response_cache table, survives restarts."""
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._writes = 0
+
+    async def get(self, kind: str, key: str) -> Optional[str]:
+        return await get_cached_response(make_cache_key(kind, key))
+
+    async def set(self, kind: str, key: str, value: str) -> None:
+        await store_cached_response(make_cache_key(kind, key), kind, key, value, self.ttl)
+        self._writes += 1
+        if self._writes % PRUNE_EVERY == 0:
+            await prune_cached_responses(self.max_entries)
+
+class TieredResponseCache:
+    """Looks up tiers in order and fills the faster tiers on a hit in a slower one."""
+
+    def __init__(self, tiers: List):
+        self.tiers = tiers
+
+    async def get(self, kind: str, key: str) -> Optional[str]:
+        for index, tier in enumerate(self.tiers):
+            value = await tier.get(kind, key)
+            if value is not None:
+                for upper in self.tiers[:index]:
+                    await upper.set(kind, key, value)
+                return value
+        return None
+
+    async def set(self, kind: str, key: str, value: str) -> None:
+        # Ошибки и пустые ответы не кэшируем
+        if not value:
+            return
+        for tier in self.tiers:
+            try:
+                await tier.set(kind, key, value)
+            except Exception as e:
+                logger.error(f"Error storing response in {type(tier).__name__}: {str(e)}")
+
+class NormalizingResponseCache:
+    """Keys the inner cache by the normalized query and serves near-duplicates.
+
+    On an exact miss the optional TF-IDF index over previously answered
+    queries is consulted, and the closest key above the threshold is used.
+    """
+
+    def __init__(self, inner, semantic: bool, warm_from_db: bool):
+        self.inner = inner
+        self.semantic = semantic and similarity.numpy_installed()
+        self.warm_from_db = warm_from_db
+        self._indexes = {}
+        if semantic and not self.semantic:
+            logger.warning("NumPy is not installed, similar-question lookup is disabled")
+
+    async def _get_index(self, kind: str):
+        index = self._indexes.get(kind)
+        if index is None:
+            index = similarity.SimilarityIndex(SIMILARITY_THRESHOLD, SIMILARITY_MAX_ENTRIES)
+            self._indexes[kind] = index
+            if self.warm_from_db:
+                prompts = await get_cached_prompts(kind, SIMILARITY_MAX_ENTRIES)
+                for prompt in reversed(prompts):
+                    index.add(prompt)
+                logger.info(f"Similarity index for '{kind}' warmed with {len(index)} keys")
+        return index
+
+    async def get(self, kind: str, key: str) -> Optional[str]:
+        normalized = normalize_query(key)
+        value = await self.inner.get(kind, normalized)
+        if value is not None or not self.semantic:
+            return value
+
+        index = await self._get_index(kind)
+        similar = index.find(normalized)
+        if similar is None or similar == normalized:
+            return None
+        logger.info(f"Serving '{kind}' query '{normalized}' from similar key '{similar}'")
+        return await self.inner.get(kind, similar)
+
+    async def set(self, kind: str, key: str, value: str) -> None:
+        normalized = normalize_query(key)
+        await self.inner.set(kind, normalized, value)
+        if self.semantic and value:
+            index = await self._get_index(kind)
+            index.add(normalized)
+
+def build_response_cache() -> NormalizingResponseCache:
+    """Build the response cache from AI_CACHE_BACKEND ("memory" or "db")."""
+    backend = os.environ.get("AI_CACHE_BACKEND", "db").lower()
+    tiers = [MemoryResponseCache(MEMORY_CACHE_SIZE, CACHE_TTL)]
+    if backend == "db":
+        tiers.append(DatabaseResponseCache(CACHE_TTL, DB_CACHE_MAX_ENTRIES))
+    logger.info(f"AI response cache tiers: {[type(tier).__name__ for tier in tiers]}")
+    return NormalizingResponseCache(
+        TieredResponseCache(tiers),
+        semantic=SEMANTIC_ENABLED,
+        warm_from_db=backend == "db",
+    )
+
+response_cache = build_response_cache()
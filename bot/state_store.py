@@ -0,0 +1,151 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Optional
+from telegram.ext import BasePersistence, PersistenceInput
+from utils.db_utils import load_user_state, save_user_states, delete_user_state
+
+logger = logging.getLogger(__name__)
+
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "db")  # db или memory
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "5"))  # seconds
+# Состояние пользователя, не писавшего этому процессу дольше TTL, перечитывается из БД:
+# за балансировщиком его могли изменить другие процессы
+STATE_CACHE_TTL = float(os.environ.get("STATE_CACHE_TTL", "30"))  # seconds
+
+class DatabaseStateBackend:
+    """Conversation state kept in the user_states table."""
+
+    async def load(self, user_id: int) -> Optional[Dict]:
+        """Stored state, an empty dict if there is none, None if the read failed."""
+        return await load_user_state(user_id)
+
+    async def save(self, states: Dict[int, Dict]) -> bool:
+        return await save_user_states(states)
+
+    async def delete(self, user_id: int) -> bool:
+        return await delete_user_state(user_id)
+
+class StatePersistence(BasePersistence):
+    """PTB persistence for context.user_data on top of a pluggable backend.
+
+    Nothing is loaded at startup: a user's state is read from the backend
+    the first time the process sees that user and then lives in PTB's
+    in-memory user_data. It is read again when the user comes back after
+    being idle in this process for cache_ttl seconds. PTB hands over changed
+    users every update_interval seconds; they are written to the backend as
+    one batch.
+    """
+
+    def __init__(self, backend, update_interval: float = STATE_FLUSH_INTERVAL, cache_ttl: float = STATE_CACHE_TTL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.backend = backend
+        # Перечитывать раньше, чем PTB передаст локальные изменения на запись, нельзя
+        self.cache_ttl = max(cache_ttl, 2 * update_interval)
+        # Время последнего обновления пользователя, чье состояние загружено
+        self._seen: Dict[int, float] = {}
+        self._pending: Dict[int, Dict] = {}
+        self._write_lock = asyncio.Lock()
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        now = time.monotonic()
+        seen_at = self._seen.get(user_id)
+        if seen_at is not None:
+            if now - seen_at < self.cache_ttl:
+                self._seen[user_id] = now
+                return
+            if user_id in self._pending or self._write_lock.locked():
+                # Незаписанное состояние этого процесса новее сохраненного, перечитаем позже
+                return
+
+        stored = await self.backend.load(user_id)
+        if stored is None:
+            # Чтение не удалось: попробуем снова при следующем обновлении пользователя
+            return
+        if seen_at is None:
+            # Значения, уже записанные обработчиками в этом процессе, новее сохраненных
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+        else:
+            # Все локальные изменения уже записаны, сохраненное состояние не старее их
+            user_data.clear()
+            user_data.update(stored)
+        self._seen[user_id] = now
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        self._pending[user_id] = data
+        # PTB вызывает update_user_data для всех измененных пользователей одновременно:
+        # уступаем цикл, чтобы они успели попасть в один пакет
+        await asyncio.sleep(0)
+        await self._write_pending()
+
+    async def _write_pending(self) -> None:
+        async with self._write_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            if not await self.backend.save(batch):
+                # Более свежие состояния, пришедшие во время записи, не затираем
+                for user_id, data in batch.items():
+                    self._pending.setdefault(user_id, data)
+                return
+            logger.debug(f"Saved conversation state of {len(batch)} users")
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+        self._seen.pop(user_id, None)
+        await self.backend.delete(user_id)
+
+    async def flush(self) -> None:
+        await self._write_pending()
+        if self._pending:
+            logger.error(f"Conversation state of {len(self._pending)} users was not saved")
+
+    # Данные чатов, бота, callback_data и состояния ConversationHandler не хранятся
+    async def get_chat_data(self) -> Dict:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+def create_persistence() -> Optional[StatePersistence]:
+    """Persistence for the configured STATE_BACKEND, None keeps state in memory only."""
+    if STATE_BACKEND == "memory":
+        return None
+    if STATE_BACKEND != "db":
+        logger.warning(f"Unknown STATE_BACKEND {STATE_BACKEND}, using db")
+    return StatePersistence(DatabaseStateBackend())
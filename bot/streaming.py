@@ -0,0 +1,88 @@
+import os
+import asyncio
+import logging
+import time
+from typing import AsyncIterator
+from telegram import Update
+from telegram.error import BadRequest, RetryAfter
+from bot.render import MAX_MESSAGE_LENGTH, split_message
+
+logger = logging.getLogger(__name__)
+
+STREAMING_ENABLED = os.environ.get("AI_STREAMING", "1") == "1"
+# Telegram ограничивает частоту редактирования, поэтому правим сообщение не чаще раза в интервал
+EDIT_INTERVAL = float(os.environ.get("AI_STREAM_EDIT_INTERVAL", "1.0"))  # seconds
+MIN_EDIT_CHARS = 20  # не редактируем ради пары новых символов
+CURSOR = " ▌"
+
+async def _edit(message, text: str, parse_mode=None) -> bool:
+    try:
+        await message.edit_text(text[:MAX_MESSAGE_LENGTH], parse_mode=parse_mode)
+        return True
+    except RetryAfter as e:
+        logger.warning(f"Telegram asked to slow down edits for {e.retry_after} seconds")
+        return False
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return True
+        if parse_mode:
+            # Ответ модели может содержать невалидный HTML, отправляем как есть
+            return await _edit(message, text)
+        logger.error(f"Failed to edit streamed message: {str(e)}")
+        return False
+
+async def _send(update: Update, text: str, parse_mode=None) -> None:
+    try:
+        await update.message.reply_text(text, parse_mode=parse_mode)
+    except BadRequest as e:
+        if not parse_mode:
+            raise
+        logger.warning(f"Failed to send streamed answer as HTML, sending as is: {str(e)}")
+        await update.message.reply_text(text)
+
+async def reply_streaming(update: Update, chunks: AsyncIterator[str]) -> str:
+    """Send an AI answer as one message that is progressively edited as chunks arrive.
+
+    Chunks are coalesced and edits are throttled to EDIT_INTERVAL. A
+    single-chunk answer (e.g. from cache) is sent once without edits. An
+    answer longer than one message is continued in follow-up messages.
+    Returns the full text.
+    """
+    text = ""
+    shown = ""
+    message = None
+    chunks_seen = 0
+    next_edit_at = 0.0
+
+    async for chunk in chunks:
+        text += chunk
+        chunks_seen += 1
+        now = time.monotonic()
+
+        if message is None:
+            # Первое сообщение отправляем со второго фрагмента, чтобы готовый ответ ушел без правок
+            if chunks_seen >= 2 and text.strip():
+                message = await update.message.reply_text((text + CURSOR)[:MAX_MESSAGE_LENGTH])
+                shown = text
+                next_edit_at = now + EDIT_INTERVAL
+            continue
+
+        if now >= next_edit_at and len(text) - len(shown) >= MIN_EDIT_CHARS:
+            if await _edit(message, text + CURSOR):
+                shown = text
+                next_edit_at = now + EDIT_INTERVAL
+            else:
+                next_edit_at = now + EDIT_INTERVAL * 3
+
+    pages = split_message(text)
+    if message is None:
+        for page in pages:
+            await _send(update, page, parse_mode='HTML')
+    else:
+        # Последняя правка убирает курсор и применяет HTML разметку,
+        # не поместившееся в сообщение отправляем следующими
+        await asyncio.sleep(max(0.0, next_edit_at - time.monotonic()))
+        await _edit(message, pages[0], parse_mode='HTML')
+        for page in pages[1:]:
+            await _send(update, page, parse_mode='HTML')
+    return text
@@ -0,0 +1,97 @@
+import os
+import asyncio
+import hmac
+import logging
+import signal
+from typing import List
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8080")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# За балансировщиком вебхук регистрирует только один воркер, остальным ставим 0
+WEBHOOK_SET_ON_START = os.environ.get("WEBHOOK_SET_ON_START", "1") == "1"
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def create_web_app(application: Application, path: str, secret_token: str = None) -> web.Application:
+    """Create the aiohttp app that feeds incoming updates into the update queue."""
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ""), secret_token
+        ):
+            logger.warning(f"Rejected webhook request with invalid secret from {request.remote}")
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        update = Update.de_json(data, application.bot)
+        if update is None:
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "queued_updates": application.update_queue.qsize()})
+
+    web_app = web.Application()
+    web_app.router.add_post(path, handle_update)
+    web_app.router.add_get("/healthz", handle_health)
+    return web_app
+
+async def serve_webhook(application: Application, allowed_updates: List[str]):
+    """Run the application behind an aiohttp webhook endpoint until SIGINT/SIGTERM."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    if WEBHOOK_SET_ON_START:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_updates
+            )
+            logger.info(f"Webhook registered at {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL is not set, skipping webhook registration")
+
+    runner = web.AppRunner(create_web_app(application, WEBHOOK_PATH, WEBHOOK_SECRET))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Stopping webhook server...")
+        # Сначала перестаем принимать запросы, затем дорабатываем очередь
+        await runner.cleanup()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def run_webhook(application: Application, allowed_updates: List[str]):
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, webhook requests are not authenticated")
+    asyncio.run(serve_webhook(application, allowed_updates))
@@ -0,0 +1,196 @@
+"""Compiled lesson and quiz content shared by the handlers and DB seeding.
+
+content/lessons.py and content/quizzes.py stay the editable source. They are
+compiled into one data file: a header, a JSON index of record offsets (relative
+to the end of the index) and one JSON record per lesson or quiz. The file is
+memory-mapped and records are decoded on demand, so a process keeps no extra
+copies of the content and a reload only swaps the mapping.
+"""
+import os
+import json
+import mmap
+import struct
+import logging
+import importlib
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CONTENT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTENT_FILE = os.environ.get("CONTENT_FILE", os.path.join(CONTENT_DIR, "content.dat"))
+CONTENT_SOURCES = ("content.lessons", "content.quizzes")
+
+MAGIC = b"MLSC"
+FORMAT_VERSION = 1
+# magic, версия формата, длина индекса в байтах
+HEADER = struct.Struct("<4sII")
+
+def _source_paths() -> List[str]:
+    return [os.path.join(CONTENT_DIR, f"{name.rsplit('.', 1)[1]}.py") for name in CONTENT_SOURCES]
+
+def _load_sources():
+    """Import the content modules, re-reading them if they were imported before."""
+    modules = []
+    for name in CONTENT_SOURCES:
+        module = importlib.import_module(name)
+        modules.append(importlib.reload(module))
+    lessons_module, quizzes_module = modules
+    return lessons_module.LESSONS, quizzes_module.QUIZZES
+
+def compile_content(path: str = CONTENT_FILE) -> str:
+    """Build the data file from the Python content modules."""
+    lessons, quizzes = _load_sources()
+
+    body = bytearray()
+    index = {"lessons": {}, "quizzes": {}}
+    for section, items in (("lessons", lessons), ("quizzes", quizzes)):
+        for item_id, item in items.items():
+            record = json.dumps(item, ensure_ascii=False).encode("utf-8")
+            index[section][str(item_id)] = [len(body), len(record)]
+            body += record
+
+    index_bytes = json.dumps(index).encode("utf-8")
+
+    # Пишем во временный файл и подменяем атомарно: процессы, у которых открыт
+    # старый файл, продолжают читать его до перезагрузки
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index_bytes)))
+        f.write(index_bytes)
+        f.write(body)
+    os.replace(tmp_path, path)
+
+    logger.info(f"Compiled {len(lessons)} lessons and {len(quizzes)} quizzes into {path} ({HEADER.size + len(index_bytes) + len(body)} bytes)")
+    return path
+
+class _Mapping:
+    __slots__ = ("data", "lessons", "quizzes", "mtime_ns")
+
+    def __init__(self, data: mmap.mmap, lessons: Dict, quizzes: Dict, mtime_ns: int):
+        self.data = data
+        self.lessons = lessons
+        self.quizzes = quizzes
+        self.mtime_ns = mtime_ns
+
+class ContentStore:
+    """Read-only access to compiled lessons and quizzes with hot reload.
+
+    Listeners registered with add_listener() are called after every load,
+    e.g. to re-render cached messages. The data file is mapped into memory, so
+    it must only be replaced (as compile_content does), never rewritten in place.
+    """
+
+    def __init__(self, path: str = CONTENT_FILE):
+        self.path = path
+        self._mapping: Optional[_Mapping] = None
+        self._listeners: List[Callable[["ContentStore"], None]] = []
+
+    def add_listener(self, callback: Callable[["ContentStore"], None]) -> None:
+        """Register a reload callback, called at once if content is already loaded."""
+        self._listeners.append(callback)
+        if self._mapping is not None:
+            callback(self)
+
+    def _sources_changed(self) -> bool:
+        try:
+            data_mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return True
+        return any(os.stat(source).st_mtime_ns > data_mtime for source in _source_paths() if os.path.exists(source))
+
+    def _load(self) -> None:
+        with open(self.path, "rb") as f:
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, index_length = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            data.close()
+            raise ValueError(f"Unsupported content file {self.path}")
+        data_start = HEADER.size + index_length
+        index = json.loads(data[HEADER.size:data_start])
+
+        # Старое отображение не закрываем явно: его освободит сборщик мусора,
+        # когда на него не останется ссылок
+        self._mapping = _Mapping(
+            data,
+            {int(key): (data_start + offset, length) for key, (offset, length) in index["lessons"].items()},
+            {int(key): (data_start + offset, length) for key, (offset, length) in index["quizzes"].items()},
+            mtime_ns
+        )
+        logger.info(f"Loaded content from {self.path}: {len(self._mapping.lessons)} lessons, {len(self._mapping.quizzes)} quizzes")
+
+        for callback in self._listeners:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"Error in content reload listener: {str(e)}", exc_info=True)
+
+    def ensure_loaded(self) -> None:
+        """Load the data file, compiling it first if it is missing or stale."""
+        if self._mapping is not None:
+            return
+        if self._sources_changed():
+            compile_content(self.path)
+        try:
+            self._load()
+        except (OSError, ValueError) as e:
+            # Поврежденный файл при старте просто собираем заново из исходников
+            logger.warning(f"Content file {self.path} is unreadable ({str(e)}), recompiling")
+            compile_content(self.path)
+            self._load()
+
+    def reload(self, force: bool = False) -> bool:
+        """Pick up changed content, returns True if a new version was loaded.
+
+        Edited source modules are recompiled; a data file replaced by another
+        process is simply remapped. force recompiles unconditionally.
+        """
+        try:
+            if force or self._sources_changed():
+                compile_content(self.path)
+            mtime_ns = os.stat(self.path).st_mtime_ns
+            if self._mapping is not None and mtime_ns == self._mapping.mtime_ns:
+                return False
+            self._load()
+            return True
+        except Exception as e:
+            # Битый контент не должен ронять бота, продолжаем работать со старой версией
+            logger.error(f"Error reloading content: {str(e)}", exc_info=True)
+            return False
+
+    def _read(self, section: str, item_id: int) -> Optional[Dict]:
+        self.ensure_loaded()
+        mapping = self._mapping
+        entry = getattr(mapping, section).get(item_id)
+        if entry is None:
+            return None
+        offset, length = entry
+        return json.loads(mapping.data[offset:offset + length])
+
+    def lesson(self, lesson_id: int) -> Optional[Dict]:
+        return self._read("lessons", lesson_id)
+
+    def quiz(self, quiz_id: int) -> Optional[Dict]:
+        return self._read("quizzes", quiz_id)
+
+    def lesson_ids(self) -> List[int]:
+        self.ensure_loaded()
+        return sorted(self._mapping.lessons)
+
+    def quiz_ids(self) -> List[int]:
+        self.ensure_loaded()
+        return sorted(self._mapping.quizzes)
+
+    def lesson_count(self) -> int:
+        self.ensure_loaded()
+        return len(self._mapping.lessons)
+
+    def lessons(self) -> Dict[int, Dict]:
+        """All lessons decoded, for one-off passes such as seeding or rendering."""
+        return {lesson_id: self.lesson(lesson_id) for lesson_id in self.lesson_ids()}
+
+    def quizzes(self) -> Dict[int, Dict]:
+        return {quiz_id: self.quiz(quiz_id) for quiz_id in self.quiz_ids()}
+
+content_store = ContentStore()
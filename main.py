@@ -1,14 +1,24 @@
 import os
+import argparse
 import logging
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
+from utils.startup import startup_timer
+from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from bot.handlers import (
     start, help_command, handle_lesson, handle_quiz,
     handle_progress, handle_answer, handle_ask, handle_explain,
-    handle_history, handle_meme, handle_stats, handle_user_stats
+    handle_history, handle_meme, handle_stats, handle_stats_page,
+    handle_user_stats, handle_ai_stats, handle_dashboard, handle_reload_content,
+    watch_content, init_content, CONTENT_WATCH_INTERVAL
 )
+from bot.ai_helper import close_client
+from bot.activity import activity_buffer
+from bot.state_store import create_persistence
+from bot.history_pool import refill_history_pool, REFILL_INTERVAL
 from app import init_db
 from dotenv import load_dotenv
 
+startup_timer.record("imports", startup_timer.started_at)
+
 # Load environment variables
 load_dotenv()
 
@@ -19,11 +29,118 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+async def post_init(application):
+    """Load content and start background tasks that live as long as the application."""
+    with startup_timer.phase("content"):
+        init_content()
+    activity_buffer.start()
+    startup_timer.report()
+
+async def post_shutdown(application):
+    """Release shared resources when the bot stops."""
+    # Гарантированно записываем накопленную активность до выхода
+    await activity_buffer.stop()
+    await close_client()
+
+def build_application(bot_token: str, with_updater: bool = True):
+    """Build the bot application with optimized settings.
+
+    Sharded workers receive updates from the supervisor and are built
+    without an updater.
+    """
+    logger.info("Initializing bot application...")
+    builder = ApplicationBuilder().token(bot_token)
+    if not with_updater:
+        builder = builder.updater(None)
+    # Состояние диалогов (текущий тест, вопрос урока) переживает перезапуск
+    persistence = create_persistence()
+    if persistence:
+        builder = builder.persistence(persistence)
+    application = builder \
+        .concurrent_updates(True) \
+        .connection_pool_size(8) \
+        .connect_timeout(30) \
+        .read_timeout(30) \
+        .write_timeout(30) \
+        .pool_timeout(30) \
+        .post_init(post_init) \
+        .post_shutdown(post_shutdown) \
+        .build()
+    logger.info("Bot application built successfully")
+    return application
+
+def register_handlers(application, with_jobs: bool = True):
+    """Add command handlers and background jobs to the application."""
+    logger.info("Adding command handlers...")
+    handlers = [
+        CommandHandler("start", start),
+        CommandHandler("help", help_command),
+        CommandHandler("lesson", handle_lesson),
+        CommandHandler("quiz", handle_quiz),
+        CommandHandler("progress", handle_progress),
+        CommandHandler("ask", handle_ask),
+        CommandHandler("explain", handle_explain),
+        CommandHandler("history", handle_history),
+        CommandHandler("meme", handle_meme),
+        CommandHandler("stats", handle_stats),
+        CommandHandler("user_stats", handle_user_stats),
+        CommandHandler("ai_stats", handle_ai_stats),
+        CommandHandler("dashboard", handle_dashboard),
+        CommandHandler("reload_content", handle_reload_content),
+        CallbackQueryHandler(handle_stats_page, pattern=r"^stats:"),
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_answer)
+    ]
+
+    for handler in handlers:
+        application.add_handler(handler)
+        if isinstance(handler, CommandHandler):
+            logger.info(f"Added handler for commands: {handler.commands}")
+        elif isinstance(handler, CallbackQueryHandler):
+            logger.info(f"Added callback query handler for pattern: {handler.pattern.pattern}")
+        else:
+            logger.info("Added message handler for text messages")
+
+    logger.info("All handlers added successfully")
+
+    # Каждый процесс держит свою копию контента, поэтому проверка нужна во всех воркерах
+    if CONTENT_WATCH_INTERVAL > 0:
+        application.job_queue.run_repeating(
+            watch_content,
+            interval=CONTENT_WATCH_INTERVAL,
+            first=CONTENT_WATCH_INTERVAL,
+            name="content_watch"
+        )
+
+    if not with_jobs:
+        return
+
+    # Фоновое пополнение пула исторических справок
+    application.job_queue.run_repeating(
+        refill_history_pool,
+        interval=REFILL_INTERVAL,
+        first=5,
+        name="history_pool_refill"
+    )
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ML study Telegram bot")
+    parser.add_argument(
+        "--mode",
+        choices=["polling", "webhook"],
+        default=os.environ.get("BOT_MODE", "polling"),
+        help="how to receive updates (default: BOT_MODE or polling)"
+    )
+    return parser.parse_args()
+
 def main():
     """Main function to run the bot with improved error handling and logging."""
+    args = parse_args()
     try:
         # Initialize database
-        init_db()
+        with startup_timer.phase("init_db"):
+            init_db()
         logger.info("Database initialized successfully")
 
         # Get bot token from environment
@@ -35,48 +152,21 @@ def main():
             # Log partial token for verification (first 5 chars)
             logger.info(f"Found bot token starting with: {bot_token[:5]}...")
 
-        # Initialize the bot with optimized settings
-        logger.info("Initializing bot application...")
-        application = ApplicationBuilder().token(bot_token) \
-            .concurrent_updates(True) \
-            .connection_pool_size(8) \
-            .connect_timeout(30) \
-            .read_timeout(30) \
-            .write_timeout(30) \
-            .pool_timeout(30) \
-            .build()
-        logger.info("Bot application built successfully")
-
-        # Add handlers with logging
-        logger.info("Adding command handlers...")
-        handlers = [
-            CommandHandler("start", start),
-            CommandHandler("help", help_command),
-            CommandHandler("lesson", handle_lesson),
-            CommandHandler("quiz", handle_quiz),
-            CommandHandler("progress", handle_progress),
-            CommandHandler("ask", handle_ask),
-            CommandHandler("explain", handle_explain),
-            CommandHandler("history", handle_history),
-            CommandHandler("meme", handle_meme),
-            CommandHandler("stats", handle_stats),
-            CommandHandler("user_stats", handle_user_stats),
-            MessageHandler(filters.TEXT & ~filters.COMMAND, handle_answer)
-        ]
-
-        for handler in handlers:
-            application.add_handler(handler)
-            if isinstance(handler, CommandHandler):
-                logger.info(f"Added handler for commands: {handler.commands}")
-            else:
-                logger.info("Added message handler for text messages")
-
-        logger.info("All handlers added successfully")
+        with startup_timer.phase("application"):
+            application = build_application(bot_token)
+            register_handlers(application)
+
+        if args.mode == "webhook":
+            from bot.webhook import run_webhook
+            logger.info("Bot initialized successfully, starting webhook server...")
+            run_webhook(application, allowed_updates=ALLOWED_UPDATES)
+            return
+
         logger.info("Bot initialized successfully, starting polling...")
 
         # Start the bot with optimized settings
         application.run_polling(
-            allowed_updates=["message", "callback_query"],
+            allowed_updates=ALLOWED_UPDATES,
             drop_pending_updates=True
         )
 
@@ -85,4 +175,4 @@ def main():
         raise
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,91 @@
+"""Maintenance commands for the bot database.
+
+Usage:
+    python manage.py recompute-stats
+    python manage.py rebuild-funnel
+    python manage.py build-content
+    python manage.py migrate
+    python manage.py check-indexes
+"""
+import sys
+import argparse
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+def recompute_stats(args):
+    from utils.db_utils import recompute_user_statistics
+    updated = recompute_user_statistics()
+    logger.info(f"Statistics recomputed for {updated} users")
+
+def rebuild_funnel(args):
+    from utils.db_utils import rebuild_lesson_funnel
+    lessons = rebuild_lesson_funnel()
+    logger.info(f"Lesson funnel rebuilt for {lessons} lessons")
+
+def build_content(args):
+    from content.store import compile_content
+    path = compile_content()
+    logger.info(f"Content compiled into {path}")
+
+def migrate(args):
+    # init_db пропускает проверку схемы по маркеру, здесь миграции применяются без него
+    from app import engine, schema_fingerprint
+    from migrations import run_migrations, schema_lock
+    with schema_lock(engine):
+        applied = run_migrations(engine)
+    logger.info(f"Applied {applied} migrations, schema marker {schema_fingerprint()}")
+
+def check_indexes(args):
+    from app import engine
+    from utils.query_plans import check_query_plans
+    results = check_query_plans(engine)
+    for name, uses_index, summary in results:
+        print(f"{'OK  ' if uses_index else 'FAIL'} {name}: {summary}")
+    if not all(uses_index for _, uses_index, _ in results):
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser(
+        "recompute-stats",
+        help="rebuild score sums, averages and attempt counters in user_statistics"
+    ).set_defaults(func=recompute_stats)
+
+    subparsers.add_parser(
+        "rebuild-funnel",
+        help="recompute the lesson_funnel summary table from users and progress"
+    ).set_defaults(func=rebuild_funnel)
+
+    subparsers.add_parser(
+        "build-content",
+        help="compile content/lessons.py and content/quizzes.py into the data file read by the bot"
+    ).set_defaults(func=build_content)
+
+    subparsers.add_parser(
+        "migrate",
+        help="create missing tables, columns and indexes and apply pending migrations"
+    ).set_defaults(func=migrate)
+
+    subparsers.add_parser(
+        "check-indexes",
+        help="EXPLAIN the hot queries and fail if any of them does not use an index"
+    ).set_defaults(func=check_indexes)
+
+    args = parser.parse_args()
+
+    from app import init_db
+    init_db()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Ordered schema migrations applied by init_db.
+
+create_all creates missing tables and app.py adds missing columns and
+indexes. Changes that cannot be derived from the models, such as dropping
+indexes or cleaning data before a new constraint, are listed here. Each
+migration runs in its own transaction and is recorded by version in
+schema_migrations, so it is applied once per database.
+"""
+import logging
+from contextlib import contextmanager
+from typing import Callable, NamedTuple
+from sqlalchemy import text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock в PostgreSQL, общий для всех процессов бота
+SCHEMA_LOCK_KEY = 0x4D4C5342
+
+class Migration(NamedTuple):
+    version: str
+    description: str
+    apply: Callable[[Connection], None]
+
+def _dedupe_progress(connection: Connection) -> None:
+    # Перед уникальным индексом по (user_id, lesson_id) оставляем одну запись на пару:
+    # завершенную, с лучшим баллом, самую позднюю
+    result = connection.execute(text("""
+        DELETE FROM progress WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY user_id, lesson_id
+                    ORDER BY completed DESC, quiz_score DESC, id DESC
+                ) AS position
+                FROM progress
+            ) ranked
+            WHERE position > 1
+        )
+    """))
+    if result.rowcount:
+        logger.warning(f"Removed {result.rowcount} duplicate progress rows")
+
+def _drop_redundant_indexes(connection: Connection) -> None:
+    # idx_telegram_id и idx_user_stats повторяют уникальные ограничения,
+    # idx_user_lesson заменен уникальным uq_progress_user_lesson
+    for index_name in ("idx_telegram_id", "idx_user_stats", "idx_user_lesson"):
+        connection.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+
+def _backfill_score_totals(connection: Connection) -> None:
+    # score_sum и score_count добавлены со значением 0: без пересчета следующий тест
+    # заменил бы средний балл существующих пользователей одной оценкой
+    from utils.db_utils import recompute_statistics_statements
+    insert_missing, recompute = recompute_statistics_statements()
+    connection.execute(insert_missing)
+    result = connection.execute(recompute)
+    logger.info(f"Backfilled score totals for {result.rowcount} users")
+
+def _rebuild_funnel_attempts(connection: Connection) -> None:
+    # Счетчик попыток воронки теперь учитывает и неверные ответы; пересчитываем его
+    # по сохраненным данным (колонку, удаленную в старой версии, вернул init_db)
+    from models import LessonFunnel
+    from utils.db_utils import funnel_attempts_subquery
+    connection.execute(update(LessonFunnel).values(attempts=funnel_attempts_subquery(LessonFunnel.lesson_id)))
+
+def _recount_completed_lessons(connection: Connection) -> None:
+    # 0003 считала завершенные уроки по lesson_attempts и обнулила их у пользователей,
+    # прошедших уроки до появления этой таблицы
+    from utils.db_utils import recompute_statistics_statements
+    _, recompute = recompute_statistics_statements()
+    result = connection.execute(recompute)
+    logger.info(f"Recounted completed lessons for {result.rowcount} users")
+
+MIGRATIONS = [
+    Migration("0001_dedupe_progress", "keep one progress row per user and lesson", _dedupe_progress),
+    Migration("0002_drop_redundant_indexes", "drop indexes duplicated by unique constraints", _drop_redundant_indexes),
+    Migration("0003_backfill_score_totals", "fill user_statistics score sums and counts from progress", _backfill_score_totals),
+    # 0004 удаляла lesson_funnel.attempts; колонка возвращена, номер повторно не используется
+    Migration("0005_rebuild_funnel_attempts", "count correct and wrong quiz answers in lesson_funnel", _rebuild_funnel_attempts),
+    Migration("0006_recount_completed_lessons", "count completed lessons and attempts from progress", _recount_completed_lessons),
+]
+
+@contextmanager
+def schema_lock(engine: Engine):
+    """Serialize schema changes between processes starting at the same time.
+
+    On PostgreSQL a session advisory lock is held on a dedicated connection;
+    callers re-check what is already applied after acquiring it. SQLite
+    serializes writers itself, so nothing is locked there.
+    """
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as lock_connection:
+        lock_connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        try:
+            yield
+        finally:
+            lock_connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+
+def record_version(connection: Connection, version: str) -> None:
+    """Insert a migration version or schema marker, ignoring one already recorded."""
+    from models import SchemaMigration
+    insert = pg_insert if connection.dialect.name == "postgresql" else sqlite_insert
+    connection.execute(insert(SchemaMigration).values(version=version).on_conflict_do_nothing())
+
+def run_migrations(engine: Engine) -> int:
+    """Apply migrations not yet recorded in schema_migrations, returns how many ran.
+
+    Call it inside schema_lock(): the applied versions are read here, so
+    they are current once the lock is held.
+    """
+    with engine.connect() as connection:
+        applied = set(connection.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+    count = 0
+    for migration in MIGRATIONS:
+        if migration.version in applied:
+            continue
+        with engine.begin() as connection:
+            migration.apply(connection)
+            record_version(connection, migration.version)
+        logger.info(f"Applied migration {migration.version}: {migration.description}")
+        count += 1
+    return count
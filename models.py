@@ -7,18 +7,13 @@ class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False)
+    telegram_id = Column(Integer, unique=True, nullable=False)  # уникальный индекс обслуживает поиск по telegram_id
     username = Column(String(64))
     current_lesson = Column(Integer, default=1)
     created_at = Column(DateTime, default=datetime.utcnow)
     progress = relationship('Progress', backref='user', lazy=True)
     statistics = relationship('UserStatistics', backref='user', uselist=False)
 
-    # Add index for faster lookups
-    __table_args__ = (
-        Index('idx_telegram_id', 'telegram_id'),
-    )
-
     def __repr__(self):
         return f'<User {self.username}>'
 
@@ -33,9 +28,15 @@ class Progress(Base):
     completed_at = Column(DateTime, default=datetime.utcnow)
     attempts = Column(Integer, default=1)  # Добавляем подсчет попыток
 
-    # Add composite index for faster progress lookups
     __table_args__ = (
-        Index('idx_user_lesson', 'user_id', 'lesson_id'),
+        # Одна запись на пару пользователь-урок, нужна для upsert (ON CONFLICT)
+        Index('uq_progress_user_lesson', 'user_id', 'lesson_id', unique=True),
+        # Частичный индекс: подсчет завершивших урок не читает незавершенные записи
+        Index(
+            'idx_progress_completed_lesson', 'lesson_id',
+            postgresql_where=completed.is_(True),
+            sqlite_where=completed.is_(True)
+        ),
     )
 
     def __repr__(self):
@@ -48,12 +49,16 @@ class UserStatistics(Base):
     user_id = Column(Integer, ForeignKey('users.id'), unique=True, nullable=False)
     total_time_spent = Column(Integer, default=0)  # в минутах
     average_score = Column(Float, default=0.0)
+    # Накопительные суммы для average_score, обновляются одним UPDATE без пересчета по progress
+    score_sum = Column(Integer, default=0, server_default='0', nullable=False)
+    score_count = Column(Integer, default=0, server_default='0', nullable=False)
     completed_lessons = Column(Integer, default=0)
     total_attempts = Column(Integer, default=0)
     last_activity = Column(DateTime, default=datetime.utcnow)
 
+    # user_id уже уникален, отдельный индекс нужен только для выборок активности по времени
     __table_args__ = (
-        Index('idx_user_stats', 'user_id'),
+        Index('idx_user_stats_last_activity', 'last_activity'),
     )
 
     def __repr__(self):
@@ -89,6 +94,7 @@ class Lesson(Base):
     order = Column(Integer, nullable=False, unique=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     estimated_time = Column(Integer, default=30)  # Примерное время прохождения в минутах
+    content_hash = Column(String(64))  # sha256 контента, по нему синхронизация пропускает неизмененные уроки
 
     quiz = relationship("Quiz", backref="lesson", uselist=False)
     attempts = relationship("LessonAttempt", backref="lesson")
@@ -106,6 +112,103 @@ class Quiz(Base):
     correct_answer = Column(String(10), nullable=False)
     explanation = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    content_hash = Column(String(64))  # sha256 контента теста
+
+    def __repr__(self):
+        return f'<Quiz {self.title}>'
+
+class AIResponseCache(Base):
+    __tablename__ = 'ai_response_cache'
+
+    cache_key = Column(String(64), primary_key=True)  # sha256 от kind и запроса
+    kind = Column(String(32), nullable=False)
+    prompt = Column(Text, nullable=False)
+    response = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('idx_ai_cache_expires', 'expires_at'),
+    )
+
+    def __repr__(self):
+        return f'<AIResponseCache {self.kind} {self.cache_key[:8]}>'
+
+class HistoryItem(Base):
+    __tablename__ = 'history_items'
+
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), unique=True, nullable=False)  # для защиты от повторов
+    history = Column(Text, nullable=False)
+    question = Column(Text, nullable=False)
+    correct_answer = Column(String(10), nullable=False)
+    explanation = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    served_at = Column(DateTime, nullable=True)  # NULL - справка еще в пуле
+
+    __table_args__ = (
+        Index('idx_history_served', 'served_at'),
+    )
+
+    def __repr__(self):
+        return f'<HistoryItem {self.id}>'
+
+class MemeAsset(Base):
+    __tablename__ = 'meme_assets'
+
+    id = Column(Integer, primary_key=True)
+    concept_key = Column(String(255), nullable=False)  # нормализованная тема мема
+    file_path = Column(String(255), nullable=True)  # NULL после вытеснения с диска
+    file_size = Column(Integer, default=0)
+    telegram_file_id = Column(String(255), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('idx_meme_concept', 'concept_key'),
+    )
+
+    def __repr__(self):
+        return f'<MemeAsset {self.concept_key} {self.id}>'
+
+class LessonFunnel(Base):
+    __tablename__ = 'lesson_funnel'
+
+    # Сводка по уроку, обновляется инкрементально и пересобирается командой manage.py rebuild-funnel
+    lesson_id = Column(Integer, primary_key=True)
+    users_reached = Column(Integer, default=0, server_default='0', nullable=False)
+    users_completed = Column(Integer, default=0, server_default='0', nullable=False)
+    # Все ответы на тест урока, верные и неверные
+    attempts = Column(Integer, default=0, server_default='0', nullable=False)
+    score_sum = Column(Integer, default=0, server_default='0', nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    @property
+    def users_stuck(self):
+        return self.users_reached - self.users_completed
+
+    @property
+    def average_score(self):
+        return self.score_sum / self.users_completed if self.users_completed else 0.0
+
+    def __repr__(self):
+        return f'<LessonFunnel lesson_id={self.lesson_id}>'
+
+class UserState(Base):
+    __tablename__ = 'user_states'
+
+    telegram_id = Column(Integer, primary_key=True)
+    data = Column(Text, nullable=False)  # context.user_data в JSON: текущие тест, вопрос урока, справка
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<UserState telegram_id={self.telegram_id}>'
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+
+    version = Column(String(64), primary_key=True)  # имя миграции или отпечаток схемы моделей
+    applied_at = Column(DateTime, default=datetime.utcnow)
 
     def __repr__(self):
-        return f'<Quiz {self.title}>'
\ No newline at end of file
+        return f'<SchemaMigration {self.version}>'
@@ -0,0 +1,55 @@
+"""Post fake Telegram updates to a locally running webhook server.
+
+Usage:
+    python scripts/send_fake_update.py "/start"
+    python scripts/send_fake_update.py "A" --user-id 42 --count 10
+"""
+import os
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    update = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test", "username": f"test{user_id}"},
+            "text": text,
+        },
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return update
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("text", help="message text, e.g. /start")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.environ.get('WEBHOOK_PORT', '8080')}"
+                                         f"{os.environ.get('WEBHOOK_PATH', '/telegram')}")
+    parser.add_argument("--secret", default=os.environ.get("WEBHOOK_SECRET"))
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--count", type=int, default=1)
+    args = parser.parse_args()
+
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+
+    base_id = int(time.time())
+    for i in range(args.count):
+        body = json.dumps(make_update(base_id + i, args.user_id, args.text)).encode("utf-8")
+        request = urllib.request.Request(args.url, data=body, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request) as response:
+                print(f"update {base_id + i}: HTTP {response.status}")
+        except urllib.error.HTTPError as e:
+            print(f"update {base_id + i}: HTTP {e.code}")
+
+if __name__ == "__main__":
+    main()
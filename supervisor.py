@@ -0,0 +1,211 @@
+"""Run the bot as N worker processes sharded by Telegram user id.
+
+The supervisor polls Telegram and routes every update to the worker
+chosen by effective_user.id, so all updates of one user (and their
+context.user_data) stay in one process. On SIGINT/SIGTERM it stops
+polling, lets workers drain their queues and waits for them to exit.
+
+Usage:
+    python supervisor.py --workers 4
+"""
+import os
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+DRAIN_TIMEOUT = int(os.environ.get("WORKER_DRAIN_TIMEOUT", "30"))  # seconds
+POLL_TIMEOUT = 30  # long polling, seconds
+WORKER_SIGNALS = {signal.SIGINT, signal.SIGTERM}
+
+def shard_for(update_data: dict, workers: int) -> int:
+    """Pick the worker for an update by its sender's Telegram id."""
+    for key in ("message", "edited_message", "callback_query"):
+        sender = (update_data.get(key) or {}).get("from")
+        if sender:
+            return sender["id"] % workers
+    return 0
+
+def worker_pool_settings(workers: int) -> dict:
+    """Split the DB_POOL_SIZE/DB_MAX_OVERFLOW budget between workers."""
+    pool_size = int(os.environ.get("DB_POOL_SIZE", "10"))
+    max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+    return {
+        "DB_POOL_SIZE": str(max(1, pool_size // workers)),
+        "DB_MAX_OVERFLOW": str(max(0, max_overflow // workers)),
+    }
+
+def worker_main(index: int, queue, pool_settings: dict):
+    """Entry point of a worker process."""
+    # Останавливает воркер только супервизор, через сигнальное значение в очереди.
+    # Сигналы заблокированы с момента запуска (см. Supervisor._spawn): пришедший
+    # раньше Ctrl+C после снятия блокировки будет проигнорирован
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, WORKER_SIGNALS)
+    os.environ.update(pool_settings)
+    asyncio.run(_run_worker(index, queue))
+
+async def _run_worker(index: int, queue):
+    from telegram import Update
+    from main import build_application, register_handlers
+    from utils.startup import startup_timer
+
+    with startup_timer.phase("application"):
+        application = build_application(os.environ["TELEGRAM_BOT_TOKEN"], with_updater=False)
+        # Фоновые задачи запускаем только в одном воркере
+        register_handlers(application, with_jobs=index == 0)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"Worker {index} started")
+
+    loop = asyncio.get_running_loop()
+    processed = 0
+    while True:
+        update_data = await loop.run_in_executor(None, queue.get)
+        if update_data is None:
+            break
+        await application.update_queue.put(Update.de_json(update_data, application.bot))
+        processed += 1
+
+    logger.info(f"Worker {index} draining after {processed} updates")
+    await application.stop()
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    logger.info(f"Worker {index} stopped")
+
+class Supervisor:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self.pool_settings = worker_pool_settings(workers)
+
+    def _spawn(self, index: int):
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.queues[index], self.pool_settings),
+            name=f"worker-{index}",
+            daemon=False
+        )
+        # Дочерний процесс наследует маску сигналов: до установки обработчиков
+        # в worker_main Ctrl+C в терминале его не остановит
+        previous_mask = signal.pthread_sigmask(signal.SIG_BLOCK, WORKER_SIGNALS)
+        try:
+            process.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, previous_mask)
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        logger.info(f"Started {self.workers} workers with DB pool settings {self.pool_settings}")
+
+    def check_workers(self):
+        """Restart workers that died unexpectedly, their queues are kept."""
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                self._spawn(index)
+
+    def dispatch(self, update_data: dict):
+        self.queues[shard_for(update_data, self.workers)].put(update_data)
+
+    def drain(self):
+        for queue in self.queues:
+            queue.put(None)
+        for index, process in enumerate(self.processes):
+            process.join(DRAIN_TIMEOUT)
+            if process.is_alive():
+                # SIGTERM воркер игнорирует, поэтому завершаем принудительно
+                logger.warning(f"Worker {index} did not drain in {DRAIN_TIMEOUT}s, killing")
+                process.kill()
+                process.join()
+        logger.info("All workers stopped")
+
+async def poll_updates(supervisor: Supervisor, bot_token: str, allowed_updates):
+    from telegram import Bot
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with Bot(bot_token) as bot:
+        await bot.delete_webhook(drop_pending_updates=True)
+        offset = None
+        while not stop_event.is_set():
+            fetch = asyncio.create_task(bot.get_updates(
+                offset=offset,
+                timeout=POLL_TIMEOUT,
+                read_timeout=POLL_TIMEOUT + 10,
+                allowed_updates=allowed_updates
+            ))
+            stop_wait = asyncio.create_task(stop_event.wait())
+            await asyncio.wait({fetch, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+            stop_wait.cancel()
+            if not fetch.done():
+                fetch.cancel()
+                break
+
+            try:
+                updates = fetch.result()
+            except Exception as e:
+                logger.error(f"Error fetching updates: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                supervisor.dispatch(update.to_dict())
+                offset = update.update_id + 1
+            supervisor.check_workers()
+
+        if offset is not None:
+            # Подтверждаем обработанные обновления, чтобы Telegram не прислал их повторно
+            await bot.get_updates(offset=offset, timeout=0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as sharded worker processes")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("BOT_WORKERS", os.cpu_count() or 1)),
+        help="number of worker processes (default: BOT_WORKERS or CPU count)"
+    )
+    args = parser.parse_args()
+
+    bot_token = os.environ.get("TELEGRAM_BOT_TOKEN")
+    if not bot_token:
+        logger.error("TELEGRAM_BOT_TOKEN not found in environment variables")
+        return
+
+    from app import init_db
+    from main import ALLOWED_UPDATES
+    init_db()
+
+    supervisor = Supervisor(args.workers)
+    supervisor.start()
+    try:
+        asyncio.run(poll_updates(supervisor, bot_token, ALLOWED_UPDATES))
+    finally:
+        logger.info("Stopping workers...")
+        supervisor.drain()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Tests run against a throwaway SQLite database and content file.
+
+The environment is configured before app is imported, because app creates
+its engines at import time.
+"""
+import os
+import sys
+import asyncio
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp_dir = tempfile.mkdtemp(prefix="mlstudybot-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp_dir, 'test.db')}"
+os.environ["CONTENT_FILE"] = os.path.join(_tmp_dir, "content.dat")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("ADMIN_TELEGRAM_ID", "1")
+
+import app  # noqa: E402
+
+_telegram_ids = iter(range(1_000_000, 2_000_000))
+
+@pytest.fixture(scope="session")
+def engine():
+    app.init_db()
+    return app.engine
+
+@pytest.fixture
+def run(engine):
+    """Run a coroutine on a fresh event loop; pooled aiosqlite connections are bound to the loop."""
+    def _run(coro):
+        async def wrapper():
+            try:
+                return await coro
+            finally:
+                await app.async_engine.dispose()
+        return asyncio.run(wrapper())
+    return _run
+
+@pytest.fixture
+def new_user(run):
+    """Create a user with a telegram_id no other test uses, returns the cached user."""
+    from utils.db_utils import get_or_create_user
+
+    def _new_user():
+        return run(get_or_create_user(next(_telegram_ids), "tester"))
+    return _new_user
@@ -0,0 +1,46 @@
+from sqlalchemy import text
+
+import bot.activity
+from bot.activity import ActivityBuffer
+
+def _scalar(engine, sql: str, **params):
+    with engine.connect() as connection:
+        return connection.execute(text(sql), params).scalar()
+
+def test_wrong_answers_become_failed_attempts(engine, run, new_user):
+    user = new_user()
+    funnel_before = _scalar(engine, "SELECT COALESCE(SUM(attempts), 0) FROM lesson_funnel WHERE lesson_id = 2")
+
+    async def answer_twice():
+        buffer = ActivityBuffer(flush_interval=60, max_events=100)
+        buffer.record_wrong_answer(user.id, 2)
+        buffer.record_wrong_answer(user.id, 2)
+        return await buffer.flush()
+
+    assert run(answer_twice()) == 1
+    assert _scalar(
+        engine, "SELECT COUNT(*) FROM lesson_attempts WHERE user_id = :user_id AND lesson_id = 2 AND success = 0",
+        user_id=user.id
+    ) == 2
+    assert _scalar(engine, "SELECT total_attempts FROM user_statistics WHERE user_id = :user_id", user_id=user.id) == 2
+    assert _scalar(engine, "SELECT attempts FROM lesson_funnel WHERE lesson_id = 2") == funnel_before + 2
+
+def test_failed_flush_keeps_wrong_answers(engine, run, new_user, monkeypatch):
+    user = new_user()
+    real_apply = bot.activity.apply_activity_batch
+
+    async def failing_apply(events, wrong_answers):
+        return False
+
+    async def flush_after_failure():
+        buffer = ActivityBuffer(flush_interval=60, max_events=100)
+        buffer.record_wrong_answer(user.id, 3)
+        monkeypatch.setattr(bot.activity, "apply_activity_batch", failing_apply)
+        assert await buffer.flush() == 0
+        monkeypatch.setattr(bot.activity, "apply_activity_batch", real_apply)
+        return await buffer.flush()
+
+    assert run(flush_after_failure()) == 1
+    assert _scalar(
+        engine, "SELECT COUNT(*) FROM lesson_attempts WHERE user_id = :user_id AND success = 0", user_id=user.id
+    ) == 1
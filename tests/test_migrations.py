@@ -0,0 +1,125 @@
+from sqlalchemy import inspect, text
+
+import app
+from migrations import MIGRATIONS, record_version, run_migrations, schema_lock
+from utils.db_utils import complete_quiz_and_advance, rebuild_lesson_funnel, recompute_user_statistics
+
+def _rerun(engine, version: str) -> int:
+    """Forget that a migration ran and apply pending migrations again."""
+    with engine.begin() as connection:
+        connection.execute(text("DELETE FROM schema_migrations WHERE version = :version"), {"version": version})
+    return run_migrations(engine)
+
+def _index_names(engine, table: str):
+    return {index["name"] for index in inspect(engine).get_indexes(table)}
+
+def test_init_db_applies_every_migration_once(engine):
+    with engine.connect() as connection:
+        applied = set(connection.execute(text("SELECT version FROM schema_migrations")).scalars())
+    assert {migration.version for migration in MIGRATIONS} <= applied
+    assert run_migrations(engine) == 0
+
+def test_dedupe_progress_keeps_best_completed_row(engine, new_user):
+    user = new_user()
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX uq_progress_user_lesson"))
+        connection.execute(text(
+            "INSERT INTO progress (user_id, lesson_id, completed, quiz_score, attempts) VALUES "
+            "(:user_id, 5, 1, 50, 1), (:user_id, 5, 1, 90, 1), (:user_id, 5, 0, 100, 1)"
+        ), {"user_id": user.id})
+
+    assert _rerun(engine, "0001_dedupe_progress") == 1
+    # Уникальный индекс создается после миграции, дубликаты ему больше не мешают
+    assert app._create_missing_indexes()
+
+    with engine.connect() as connection:
+        rows = connection.execute(text(
+            "SELECT completed, quiz_score FROM progress WHERE user_id = :user_id AND lesson_id = 5"
+        ), {"user_id": user.id}).all()
+    assert rows == [(1, 90)]
+    assert "uq_progress_user_lesson" in _index_names(engine, "progress")
+
+def test_drop_redundant_indexes(engine):
+    with engine.begin() as connection:
+        connection.execute(text("CREATE INDEX idx_telegram_id ON users (telegram_id)"))
+
+    assert _rerun(engine, "0002_drop_redundant_indexes") == 1
+    assert "idx_telegram_id" not in _index_names(engine, "users")
+
+def test_backfill_score_totals(engine, run, new_user):
+    user = new_user()
+    run(complete_quiz_and_advance(user.id, 1, 60, 2))
+    run(complete_quiz_and_advance(user.id, 2, 100, 3))
+    # Так выглядели статистики после добавления колонок score_sum и score_count
+    with engine.begin() as connection:
+        connection.execute(text(
+            "UPDATE user_statistics SET score_sum = 0, score_count = 0 WHERE user_id = :user_id"
+        ), {"user_id": user.id})
+
+    assert _rerun(engine, "0003_backfill_score_totals") == 1
+
+    with engine.connect() as connection:
+        row = connection.execute(text(
+            "SELECT score_sum, score_count, average_score FROM user_statistics WHERE user_id = :user_id"
+        ), {"user_id": user.id}).one()
+    assert tuple(row) == (160, 2, 80.0)
+
+def _counters(engine, user_id: int):
+    with engine.connect() as connection:
+        return tuple(connection.execute(text(
+            "SELECT completed_lessons, total_attempts FROM user_statistics WHERE user_id = :user_id"
+        ), {"user_id": user_id}).one())
+
+def test_recompute_counts_lessons_completed_before_lesson_attempts(engine, run, new_user):
+    user = new_user()
+    run(complete_quiz_and_advance(user.id, 1, 80, 2))
+    run(complete_quiz_and_advance(user.id, 2, 100, 3))
+    # Пользователь из времени до lesson_attempts: есть только записи progress
+    with engine.begin() as connection:
+        connection.execute(text("DELETE FROM lesson_attempts WHERE user_id = :user_id"), {"user_id": user.id})
+        connection.execute(text(
+            "UPDATE user_statistics SET completed_lessons = 0, total_attempts = 0 WHERE user_id = :user_id"
+        ), {"user_id": user.id})
+
+    assert _rerun(engine, "0006_recount_completed_lessons") == 1
+    assert _counters(engine, user.id) == (2, 2)
+
+    # manage.py recompute-stats выполняет тот же пересчет
+    assert recompute_user_statistics() > 0
+    assert _counters(engine, user.id) == (2, 2)
+
+def _funnel_attempts(engine, lesson_id: int) -> int:
+    with engine.connect() as connection:
+        return connection.execute(text(
+            "SELECT attempts FROM lesson_funnel WHERE lesson_id = :lesson_id"
+        ), {"lesson_id": lesson_id}).scalar()
+
+def test_rebuild_funnel_attempts_counts_correct_and_wrong_answers(engine, run, new_user):
+    user = new_user()
+    run(complete_quiz_and_advance(user.id, 6, 100, 7))
+    run(complete_quiz_and_advance(user.id, 6, 100, 7))
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO lesson_attempts (user_id, lesson_id, started_at, completed_at, success) "
+            "VALUES (:user_id, 6, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 0)"
+        ), {"user_id": user.id})
+        expected = connection.execute(text(
+            "SELECT (SELECT COALESCE(SUM(attempts), 0) FROM progress WHERE lesson_id = 6)"
+            " + (SELECT COUNT(*) FROM lesson_attempts WHERE lesson_id = 6 AND success = 0)"
+        )).scalar()
+        connection.execute(text("UPDATE lesson_funnel SET attempts = 0 WHERE lesson_id = 6"))
+
+    assert _rerun(engine, "0005_rebuild_funnel_attempts") == 1
+    assert _funnel_attempts(engine, 6) == expected
+
+    assert rebuild_lesson_funnel() > 0
+    assert _funnel_attempts(engine, 6) == expected
+
+def test_concurrent_starts_do_not_fail_on_recorded_versions(engine):
+    # Процесс, дождавшийся блокировки, может записать уже записанные версию и маркер
+    with schema_lock(engine):
+        app._mark_schema_current(app.schema_fingerprint())
+        with engine.begin() as connection:
+            record_version(connection, MIGRATIONS[0].version)
+        assert run_migrations(engine) == 0
+    app.init_db()
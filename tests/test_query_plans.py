@@ -0,0 +1,7 @@
+from utils.query_plans import check_query_plans, hot_queries
+
+def test_hot_queries_use_indexes(engine):
+    results = check_query_plans(engine)
+    assert len(results) == len(hot_queries())
+    missing = [f"{name}: {summary}" for name, uses_index, summary in results if not uses_index]
+    assert not missing, "hot queries without an index:\n" + "\n".join(missing)
@@ -0,0 +1,62 @@
+from sqlalchemy import select
+
+import app
+from models import LessonAttempt, Progress, User, UserStatistics
+from utils.db_utils import complete_quiz_and_advance, get_cached_user, get_user_progress
+
+def _row(model, **filters):
+    with app.get_session() as session:
+        return session.scalar(select(model).filter_by(**filters))
+
+def test_completion_saves_progress_attempt_stats_and_advances(run, new_user):
+    user = new_user()
+
+    assert run(complete_quiz_and_advance(user.id, 1, 80, 2))
+
+    progress = _row(Progress, user_id=user.id, lesson_id=1)
+    assert progress.completed and progress.quiz_score == 80 and progress.attempts == 1
+    attempt = _row(LessonAttempt, user_id=user.id, lesson_id=1)
+    assert attempt.success
+    stats = _row(UserStatistics, user_id=user.id)
+    assert (stats.score_sum, stats.score_count, stats.average_score) == (80, 1, 80.0)
+    assert (stats.total_attempts, stats.completed_lessons) == (1, 1)
+    assert _row(User, id=user.id).current_lesson == 2
+    assert run(get_cached_user(user.telegram_id)).current_lesson == 2
+
+def test_repeated_completion_replaces_score(run, new_user):
+    user = new_user()
+    run(complete_quiz_and_advance(user.id, 1, 60, 2))
+
+    assert run(complete_quiz_and_advance(user.id, 1, 100, 2))
+
+    progress = _row(Progress, user_id=user.id, lesson_id=1)
+    assert (progress.quiz_score, progress.attempts) == (100, 2)
+    stats = _row(UserStatistics, user_id=user.id)
+    assert (stats.score_sum, stats.score_count, stats.average_score) == (100, 1, 100.0)
+    assert (stats.total_attempts, stats.completed_lessons) == (2, 1)
+
+def test_completing_earlier_lesson_never_moves_user_back(run, new_user):
+    user = new_user()
+    for lesson_id in (1, 2, 3):
+        run(complete_quiz_and_advance(user.id, lesson_id, 100, lesson_id + 1))
+
+    # Устаревший кэш другого процесса отправляет завершение первого урока еще раз
+    assert run(complete_quiz_and_advance(user.id, 1, 90, 2))
+
+    assert _row(User, id=user.id).current_lesson == 4
+    assert run(get_cached_user(user.telegram_id)).current_lesson == 4
+    assert _row(UserStatistics, user_id=user.id).completed_lessons == 3
+
+def test_progress_summary_follows_completions(run, new_user):
+    user = new_user()
+    assert run(get_user_progress(user.id)).count == 0
+
+    run(complete_quiz_and_advance(user.id, 1, 70, 2))
+    run(complete_quiz_and_advance(user.id, 2, 90, 3))
+
+    summary = run(get_user_progress(user.id))
+    assert summary.completed_lessons == 2 and summary.average_score == 80.0
+
+def test_unknown_user_is_rejected(run):
+    assert not run(complete_quiz_and_advance(10_000_000, 1, 100, 2))
+    assert _row(Progress, user_id=10_000_000) is None
@@ -0,0 +1,124 @@
+import time
+
+from sqlalchemy import text
+
+from bot.state_store import DatabaseStateBackend, StatePersistence
+from utils.db_utils import delete_user_state, load_user_state, save_user_states
+
+class FlakyBackend:
+    """In-memory backend whose first load and first save fail."""
+
+    def __init__(self, stored=None):
+        self.stored = dict(stored or {})
+        self.failed_loads = 0
+        self.failed_saves = 0
+
+    async def load(self, user_id):
+        if not self.failed_loads:
+            self.failed_loads += 1
+            return None
+        return self.stored.get(user_id, {})
+
+    async def save(self, states):
+        if not self.failed_saves:
+            self.failed_saves += 1
+            return False
+        self.stored.update(states)
+        return True
+
+    async def delete(self, user_id):
+        self.stored.pop(user_id, None)
+        return True
+
+def test_save_load_and_delete_round_trip(run):
+    quiz = {"current_quiz": {"quiz_id": 2, "correct_answer": "B"}}
+    assert run(save_user_states({3_000_001: quiz, 3_000_002: {"lesson_started": {"lesson_id": 1}}}))
+
+    assert run(load_user_state(3_000_001)) == quiz
+    assert run(load_user_state(3_000_002)) == {"lesson_started": {"lesson_id": 1}}
+
+    assert run(delete_user_state(3_000_001))
+    assert run(load_user_state(3_000_001)) == {}
+
+def test_missing_empty_and_broken_states_load_as_empty(engine, run):
+    assert run(load_user_state(3_000_010)) == {}
+
+    run(save_user_states({3_000_011: {"a": 1}}))
+    run(save_user_states({3_000_011: {}}))
+    assert run(load_user_state(3_000_011)) == {}
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO user_states (telegram_id, data, updated_at) VALUES (3000012, '{broken', CURRENT_TIMESTAMP)"
+        ))
+    assert run(load_user_state(3_000_012)) == {}
+
+def test_unserializable_state_does_not_block_others(run):
+    assert run(save_user_states({3_000_020: {"bad": object()}, 3_000_021: {"ok": True}}))
+    assert run(load_user_state(3_000_020)) == {}
+    assert run(load_user_state(3_000_021)) == {"ok": True}
+
+def test_persistence_loads_once_and_keeps_newer_values(run):
+    run(save_user_states({3_000_030: {"current_check": {"lesson_id": 1}, "step": "stored"}}))
+    persistence = StatePersistence(DatabaseStateBackend(), update_interval=60)
+
+    user_data = {"step": "new"}
+    run(persistence.refresh_user_data(3_000_030, user_data))
+    assert user_data == {"current_check": {"lesson_id": 1}, "step": "new"}
+
+    run(persistence.update_user_data(3_000_030, user_data))
+    assert run(load_user_state(3_000_030)) == user_data
+
+    run(persistence.drop_user_data(3_000_030))
+    assert run(load_user_state(3_000_030)) == {}
+
+def test_failed_load_is_retried_on_next_update(run):
+    backend = FlakyBackend({1: {"current_quiz": {"quiz_id": 1}}})
+    persistence = StatePersistence(backend, update_interval=60)
+    user_data = {}
+
+    run(persistence.refresh_user_data(1, user_data))
+    assert user_data == {}
+
+    run(persistence.refresh_user_data(1, user_data))
+    assert user_data == {"current_quiz": {"quiz_id": 1}}
+
+def test_failed_save_is_kept_for_flush(run):
+    backend = FlakyBackend()
+    persistence = StatePersistence(backend, update_interval=60)
+
+    run(persistence.update_user_data(1, {"step": 1}))
+    assert backend.stored == {}
+
+    run(persistence.flush())
+    assert backend.stored == {1: {"step": 1}}
+
+def test_state_changed_elsewhere_is_reloaded_after_ttl(run):
+    backend = FlakyBackend({1: {"current_quiz": {"quiz_id": 1}}})
+    backend.failed_loads = backend.failed_saves = 1
+    persistence = StatePersistence(backend, update_interval=0.01, cache_ttl=0.05)
+    user_data = {}
+    run(persistence.refresh_user_data(1, user_data))
+
+    # Другой процесс принял ответ на тест и записал новое состояние
+    backend.stored[1] = {"lesson_started": {"lesson_id": 2}}
+    run(persistence.refresh_user_data(1, user_data))
+    assert user_data == {"current_quiz": {"quiz_id": 1}}
+
+    time.sleep(0.06)
+    run(persistence.refresh_user_data(1, user_data))
+    assert user_data == {"lesson_started": {"lesson_id": 2}}
+
+def test_unsaved_local_state_is_not_replaced(run):
+    backend = FlakyBackend({1: {"step": "stored"}})
+    backend.failed_loads = 1
+    persistence = StatePersistence(backend, update_interval=0.01, cache_ttl=0.05)
+    user_data = {}
+    run(persistence.refresh_user_data(1, user_data))
+
+    # Первая запись не удалась, состояние ждет повторной записи
+    user_data["step"] = "local"
+    run(persistence.update_user_data(1, dict(user_data)))
+    time.sleep(0.06)
+    run(persistence.refresh_user_data(1, user_data))
+    assert user_data == {"step": "local"}
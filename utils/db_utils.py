@@ -1,13 +1,22 @@
+import os
+import json
+import hashlib
 import logging
-from typing import Optional, List, Dict
-from datetime import datetime
-from functools import lru_cache
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import joinedload
-from sqlalchemy import func
-from contextlib import contextmanager
-from app import get_session
-from models import User, Progress, UserStatistics, LessonAttempt, Lesson, Quiz
+import time
+from collections import Counter
+from typing import Optional, List, Dict, Tuple
+from datetime import datetime, timedelta
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy import func, select, insert, update, delete, exists, case, values, column, bindparam, Integer, DateTime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from contextlib import contextmanager, asynccontextmanager
+from app import get_session, get_async_session
+from models import (
+    User, Progress, UserStatistics, LessonAttempt, Lesson, Quiz,
+    AIResponseCache, HistoryItem, MemeAsset, LessonFunnel, UserState
+)
+from utils.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
@@ -25,27 +34,84 @@ def session_scope():
     finally:
         session.close()
 
-@lru_cache(maxsize=100)
-def get_cached_user(telegram_id: int) -> Optional[User]:
+@asynccontextmanager
+async def async_session_scope():
+    """Provide an async transactional scope around a series of operations."""
+    session = get_async_session()
+    try:
+        yield session
+        await session.commit()
+    except Exception as e:
+        logger.error(f"Session error: {str(e)}")
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+class CachedUser:
+    """Plain snapshot of a user row kept in the user cache."""
+
+    __slots__ = ("id", "telegram_id", "current_lesson")
+
+    def __init__(self, id: int, telegram_id: int, current_lesson: int):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.current_lesson = current_lesson
+
+    def __repr__(self) -> str:
+        return f"CachedUser(id={self.id}, telegram_id={self.telegram_id}, current_lesson={self.current_lesson})"
+
+# Супервизор направляет пользователя всегда в один воркер, но за балансировщиком вебхука
+# обновления одного пользователя могут попасть в разные процессы. Поэтому TTL короткий,
+# а при записи кэш заменяется значением из БД
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "60"))  # seconds
+
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+def _cache_user(user) -> CachedUser:
+    cached = CachedUser(user.id, user.telegram_id, user.current_lesson)
+    _user_cache.set(cached.telegram_id, cached)
+    return cached
+
+def invalidate_user(telegram_id: int) -> None:
+    """Drop one user from the cache."""
+    _user_cache.pop(telegram_id)
+
+def get_user_cache_stats() -> Dict:
+    return _user_cache.stats()
+
+async def get_cached_user(telegram_id: int) -> Optional[CachedUser]:
     """Get user from cache or database."""
-    with session_scope() as session:
-        return session.query(User).filter_by(telegram_id=telegram_id).first()
+    user = _user_cache.get(telegram_id)
+    if user is not None:
+        return user
+
+    async with async_session_scope() as session:
+        try:
+            row = (await session.execute(
+                select(User.id, User.telegram_id, User.current_lesson).filter_by(telegram_id=telegram_id)
+            )).first()
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in get_cached_user: {str(e)}")
+            return None
+    return _cache_user(row) if row else None
 
-def get_or_create_user(telegram_id: int, username: str = None) -> Optional[User]:
+async def get_or_create_user(telegram_id: int, username: str = None) -> Optional[CachedUser]:
     """Get existing user or create a new one with improved error handling."""
-    user = get_cached_user(telegram_id)
+    user = await get_cached_user(telegram_id)
     if user:
         logger.info(f"Found cached user: {user.id}, current_lesson: {user.current_lesson}")
         return user
 
-    with session_scope() as session:
+    async with async_session_scope() as session:
         try:
-            user = session.query(User).filter_by(telegram_id=telegram_id).first()
+            user = await session.scalar(select(User).filter_by(telegram_id=telegram_id))
             if not user:
                 # First create and flush the user to get the ID
                 user = User(telegram_id=telegram_id, username=username, current_lesson=1)
                 session.add(user)
-                session.flush()
+                await session.flush()
 
                 # Now create statistics with the user's ID
                 stats = UserStatistics(
@@ -57,73 +123,258 @@ def get_or_create_user(telegram_id: int, username: str = None) -> Optional[User]
                     last_activity=datetime.utcnow()
                 )
                 session.add(stats)
-                session.commit()
+                await session.execute(_funnel_upsert(
+                    _dialect_insert(session),
+                    [_funnel_row(user.current_lesson, datetime.utcnow(), users_reached=1)]
+                ))
+                await session.commit()
                 logger.info(f"Created new user with telegram_id {telegram_id}")
-                get_cached_user.cache_clear()
-            return user
+            return _cache_user(user)
         except SQLAlchemyError as e:
             logger.error(f"Database error in get_or_create_user: {str(e)}")
-            session.rollback()
+            await session.rollback()
             return None
 
-def start_lesson_attempt(user_id: int, lesson_id: int) -> Optional[LessonAttempt]:
-    """Create new lesson attempt."""
+async def apply_activity_batch(events: List[Dict], wrong_answers: List[Dict] = ()) -> bool:
+    """Write buffered activity and wrong quiz answers in one transaction.
+
+    Each event holds user_id and the latest last_activity since the
+    previous flush. Each wrong answer (user_id, lesson_id, answered_at)
+    becomes a failed lesson attempt and adds to total_attempts and to the
+    lesson's funnel attempts.
+    """
+    if not events and not wrong_answers:
+        return True
+    attempts_by_user = Counter(answer["user_id"] for answer in wrong_answers)
+    attempts_by_lesson = Counter(answer["lesson_id"] for answer in wrong_answers)
+    async with async_session_scope() as session:
+        try:
+            if session.bind.dialect.name == "postgresql":
+                # UPDATE ... FROM (VALUES ...): одна команда на весь пакет
+                batch = values(
+                    column("user_id", Integer),
+                    column("last_activity", DateTime),
+                    column("attempts", Integer),
+                    name="batch"
+                ).data([(e["user_id"], e["last_activity"], attempts_by_user[e["user_id"]]) for e in events])
+                await session.execute(
+                    update(UserStatistics)
+                    .where(UserStatistics.user_id == batch.c.user_id)
+                    .values(
+                        last_activity=func.greatest(UserStatistics.last_activity, batch.c.last_activity),
+                        total_attempts=UserStatistics.total_attempts + batch.c.attempts
+                    )
+                )
+            else:
+                connection = await session.connection()
+                await connection.execute(
+                    update(UserStatistics)
+                    .where(UserStatistics.user_id == bindparam("b_user_id"))
+                    .values(
+                        last_activity=bindparam("b_last_activity"),
+                        total_attempts=UserStatistics.total_attempts + bindparam("b_attempts")
+                    ),
+                    [
+                        {"b_user_id": e["user_id"], "b_last_activity": e["last_activity"],
+                         "b_attempts": attempts_by_user[e["user_id"]]}
+                        for e in events
+                    ]
+                )
+
+            if wrong_answers:
+                await session.execute(insert(LessonAttempt), [
+                    {
+                        "user_id": answer["user_id"],
+                        "lesson_id": answer["lesson_id"],
+                        "started_at": answer["answered_at"],
+                        "completed_at": answer["answered_at"],
+                        "success": False
+                    }
+                    for answer in wrong_answers
+                ])
+                now = datetime.utcnow()
+                await session.execute(_funnel_upsert(
+                    _dialect_insert(session),
+                    [_funnel_row(lesson_id, now, attempts=count) for lesson_id, count in sorted(attempts_by_lesson.items())]
+                ))
+            await session.commit()
+            return True
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in apply_activity_batch: {str(e)}")
+            return False
+
+def recompute_statistics_statements():
+    """Statements that create missing statistics rows and rebuild aggregates from progress and attempts."""
+    missing_users = select(User.id).filter(~User.statistics.has())
+    insert_missing = UserStatistics.__table__.insert().from_select(['user_id'], missing_users)
+
+    user_id = UserStatistics.user_id
+    score_sum = select(func.coalesce(func.sum(Progress.quiz_score), 0))\
+        .filter(Progress.user_id == user_id).scalar_subquery()
+    score_count = select(func.count(Progress.id))\
+        .filter(Progress.user_id == user_id).scalar_subquery()
+    # Пользователи, завершившие уроки до появления lesson_attempts, есть только в progress:
+    # верные ответы берем из progress.attempts, неверные - из неудачных попыток
+    total_attempts = select(func.coalesce(func.sum(Progress.attempts), 0))\
+        .filter(Progress.user_id == user_id).scalar_subquery() + \
+        select(func.count(LessonAttempt.id))\
+        .filter(LessonAttempt.user_id == user_id, LessonAttempt.success.is_(False)).scalar_subquery()
+    completed_lessons = select(func.count(Progress.id))\
+        .filter(Progress.user_id == user_id, Progress.completed.is_(True)).scalar_subquery()
+
+    recompute = update(UserStatistics).values(
+        score_sum=score_sum,
+        score_count=score_count,
+        average_score=func.coalesce(score_sum * 1.0 / func.nullif(score_count, 0), 0.0),
+        total_attempts=total_attempts,
+        completed_lessons=completed_lessons
+    )
+    return insert_missing, recompute
+
+def recompute_user_statistics() -> int:
+    """Rebuild score aggregates and attempt counters for all users in bulk.
+
+    Creates missing statistics rows first. Runs on the sync engine for
+    maintenance scripts; migrations run the same statements once on upgrade.
+    """
     with session_scope() as session:
         try:
-            attempt = LessonAttempt(user_id=user_id, lesson_id=lesson_id)
-            session.add(attempt)
+            insert_missing, recompute = recompute_statistics_statements()
+            session.execute(insert_missing)
+            result = session.execute(recompute)
             session.commit()
-            return attempt
+            logger.info(f"Recomputed statistics for {result.rowcount} users")
+            return result.rowcount
         except SQLAlchemyError as e:
-            logger.error(f"Error creating lesson attempt: {str(e)}")
-            return None
+            logger.error(f"Database error in recompute_user_statistics: {str(e)}")
+            return 0
+
+def funnel_attempts_subquery(lesson_id):
+    """Quiz answers for a lesson: correct completions counted in progress plus failed attempts."""
+    completions = select(func.coalesce(func.sum(Progress.attempts), 0))\
+        .filter(Progress.lesson_id == lesson_id).scalar_subquery()
+    wrong_answers = select(func.count(LessonAttempt.id))\
+        .filter(LessonAttempt.lesson_id == lesson_id, LessonAttempt.success.is_(False)).scalar_subquery()
+    return completions + wrong_answers
+
+def rebuild_lesson_funnel() -> int:
+    """Recompute lesson_funnel for every lesson from users and progress in bulk.
 
-def complete_lesson_attempt(attempt_id: int, success: bool) -> bool:
-    """Complete lesson attempt and update statistics."""
+    Runs on the sync engine for init_db and maintenance scripts.
+    """
     with session_scope() as session:
         try:
-            attempt = session.query(LessonAttempt).get(attempt_id)
-            if not attempt:
-                return False
+            lesson_id = Lesson.id
+            reached = select(func.count(User.id))\
+                .filter(User.current_lesson >= lesson_id).scalar_subquery()
+            completed = select(func.count(Progress.id))\
+                .filter(Progress.lesson_id == lesson_id, Progress.completed.is_(True)).scalar_subquery()
+            attempts = funnel_attempts_subquery(lesson_id)
+            score_sum = select(func.coalesce(func.sum(Progress.quiz_score), 0))\
+                .filter(Progress.lesson_id == lesson_id).scalar_subquery()
 
-            attempt.completed_at = datetime.utcnow()
-            attempt.success = success
-
-            # Обновляем статистику пользователя
-            stats = session.query(UserStatistics).filter_by(user_id=attempt.user_id).first()
-            if stats:
-                if success:
-                    stats.completed_lessons += 1
-                stats.total_attempts += 1
-                stats.last_activity = datetime.utcnow()
-
-                # Обновляем среднюю оценку
-                progress = session.query(Progress).filter_by(
-                    user_id=attempt.user_id
-                ).all()
-                if progress:
-                    avg_score = sum(p.quiz_score for p in progress) / len(progress)
-                    stats.average_score = avg_score
+            session.execute(delete(LessonFunnel))
+            result = session.execute(LessonFunnel.__table__.insert().from_select(
+                ["lesson_id", "users_reached", "users_completed", "attempts", "score_sum", "updated_at"],
+                select(lesson_id, reached, completed, attempts, score_sum, func.now())
+            ))
+            session.commit()
+            logger.info(f"Rebuilt lesson funnel for {result.rowcount} lessons")
+            return result.rowcount
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in rebuild_lesson_funnel: {str(e)}")
+            return 0
+
+LESSON_SYNC_COLUMNS = ("title", "content", "check_question", "check_options", "check_correct", "materials", "order", "content_hash")
+QUIZ_SYNC_COLUMNS = ("title", "question", "correct_answer", "explanation", "content_hash")
+
+def content_hash(item: Dict) -> str:
+    """Stable sha256 of a lesson or quiz dict, used to skip unchanged rows."""
+    return hashlib.sha256(json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
 
+def sync_content(lessons: Dict[int, Dict], quizzes: Dict[int, Dict]) -> Optional[Tuple[int, int]]:
+    """Upsert lessons and quizzes whose content hash differs from the DB.
+
+    Each table gets at most one INSERT ... ON CONFLICT statement; returns the
+    number of lessons and quizzes written. Rows missing from the content are
+    kept, progress and attempts still reference them.
+    """
+    with session_scope() as session:
+        try:
+            insert_stmt = _dialect_insert(session)
+            stored_lessons = dict(session.execute(select(Lesson.id, Lesson.content_hash)).all())
+            stored_quizzes = dict(session.execute(select(Quiz.lesson_id, Quiz.content_hash)).all())
+
+            lesson_rows = []
+            for lesson_id, lesson in lessons.items():
+                lesson_hash = content_hash(lesson)
+                if stored_lessons.get(lesson_id) == lesson_hash:
+                    continue
+                lesson_rows.append({
+                    "id": lesson_id,
+                    "title": lesson['title'],
+                    "content": lesson['content'],
+                    "check_question": lesson['check_question'],
+                    "check_options": json.dumps(lesson['check_options'], ensure_ascii=False),
+                    "check_correct": lesson['check_correct'],
+                    "materials": json.dumps(lesson['materials'], ensure_ascii=False),
+                    "order": lesson_id,
+                    "content_hash": lesson_hash,
+                })
+
+            quiz_rows = []
+            for lesson_id, quiz in quizzes.items():
+                quiz_hash = content_hash(quiz)
+                if stored_quizzes.get(lesson_id) == quiz_hash:
+                    continue
+                quiz_rows.append({
+                    "lesson_id": lesson_id,
+                    "title": quiz['title'],
+                    "question": quiz['question'],
+                    "correct_answer": quiz['correct_answer'],
+                    "explanation": quiz['explanation'],
+                    "content_hash": quiz_hash,
+                })
+
+            # Уроки пишем первыми: тесты ссылаются на них внешним ключом
+            if lesson_rows:
+                stmt = insert_stmt(Lesson).values(lesson_rows)
+                session.execute(stmt.on_conflict_do_update(
+                    index_elements=[Lesson.id],
+                    set_={name: stmt.excluded[name] for name in LESSON_SYNC_COLUMNS}
+                ))
+            if quiz_rows:
+                stmt = insert_stmt(Quiz).values(quiz_rows)
+                session.execute(stmt.on_conflict_do_update(
+                    index_elements=[Quiz.lesson_id],
+                    set_={name: stmt.excluded[name] for name in QUIZ_SYNC_COLUMNS}
+                ))
             session.commit()
-            return True
+
+            logger.info(
+                f"Content sync: {len(lesson_rows)} of {len(lessons)} lessons and "
+                f"{len(quiz_rows)} of {len(quizzes)} quizzes updated"
+            )
+            return len(lesson_rows), len(quiz_rows)
         except SQLAlchemyError as e:
-            logger.error(f"Error completing lesson attempt: {str(e)}")
-            return False
+            logger.error(f"Database error in sync_content: {str(e)}")
+            return None
 
-def get_user_statistics(user_id: int):
+async def get_user_statistics(user_id: int):
     """Get detailed statistics for user."""
-    with session_scope() as session:
+    async with async_session_scope() as session:
         try:
-            stats = session.query(UserStatistics).filter_by(user_id=user_id).first()
+            stats = await session.scalar(select(UserStatistics).filter_by(user_id=user_id))
             if not stats:
                 return None
 
             # Get additional information
-            total_attempts = session.query(func.count(LessonAttempt.id))\
-                .filter_by(user_id=user_id).scalar()
-            successful_attempts = session.query(func.count(LessonAttempt.id))\
-                .filter_by(user_id=user_id, success=True).scalar()
+            total_attempts = await session.scalar(
+                select(func.count(LessonAttempt.id)).filter_by(user_id=user_id)
+            )
+            successful_attempts = await session.scalar(
+                select(func.count(LessonAttempt.id)).filter_by(user_id=user_id, success=True)
+            )
 
             return {
                 "total_time_spent": stats.total_time_spent,
@@ -138,122 +389,667 @@ def get_user_statistics(user_id: int):
             logger.error(f"Error getting user statistics: {str(e)}")
             return None
 
-def get_all_users_statistics():
-    """Get statistics for all users (admin function)."""
-    with session_scope() as session:
+async def get_users_statistics_page(cursor: int, limit: int, backward: bool = False) -> List[Dict]:
+    """Get one keyset page of per-user statistics ordered by user id (admin function).
+
+    Forward pages start after the cursor id, backward pages end before it.
+    """
+    async with async_session_scope() as session:
         try:
-            users = session.query(User).options(
-                joinedload(User.statistics)
-            ).all()
-
-            result = []
-            for user in users:
-                if user.statistics:
-                    stats = {
-                        "user_id": user.id,
-                        "username": user.username,
-                        "telegram_id": user.telegram_id,
-                        "current_lesson": user.current_lesson,
-                        "total_time_spent": user.statistics.total_time_spent,
-                        "average_score": user.statistics.average_score,
-                        "completed_lessons": user.statistics.completed_lessons,
-                        "total_attempts": user.statistics.total_attempts,
-                        "last_activity": user.statistics.last_activity
-                    }
-                    result.append(stats)
+            query = select(
+                User.id.label("user_id"),
+                User.username,
+                User.telegram_id,
+                User.current_lesson,
+                UserStatistics.total_time_spent,
+                UserStatistics.average_score,
+                UserStatistics.completed_lessons,
+                UserStatistics.total_attempts,
+                UserStatistics.last_activity
+            ).join(UserStatistics, UserStatistics.user_id == User.id)
+            if backward:
+                query = query.filter(User.id < cursor).order_by(User.id.desc())
+            else:
+                query = query.filter(User.id > cursor).order_by(User.id)
 
-            return result
+            rows = [dict(row) for row in (await session.execute(query.limit(limit))).mappings()]
+            if backward:
+                rows.reverse()
+            return rows
         except SQLAlchemyError as e:
-            logger.error(f"Error getting all users statistics: {str(e)}")
+            logger.error(f"Error getting users statistics page: {str(e)}")
             return []
 
-def update_progress(user_id: int, lesson_id: int, quiz_score: int) -> bool:
-    """Update user's progress for a specific lesson with optimized queries."""
-    with session_scope() as session:
+DASHBOARD_CACHE_TTL = int(os.environ.get("DASHBOARD_CACHE_TTL", "300"))  # seconds
+
+_dashboard_cache = TTLCache(maxsize=1, ttl=DASHBOARD_CACHE_TTL)
+
+async def _read_lesson_funnel(session) -> Dict[int, Dict]:
+    funnel = await session.scalars(select(LessonFunnel).order_by(LessonFunnel.lesson_id))
+    return {
+        row.lesson_id: {
+            "reached": row.users_reached,
+            "completed": row.users_completed,
+            "stuck": row.users_stuck,
+            # Ответы на тест, верные и неверные, на одного завершившего урок
+            "avg_attempts": row.attempts / row.users_completed if row.users_completed else 0.0,
+            "avg_score": row.average_score
+        }
+        for row in funnel
+    }
+
+async def _median_quiz_score(session) -> Optional[float]:
+    if session.bind.dialect.name == "postgresql":
+        return await session.scalar(
+            select(func.percentile_cont(0.5).within_group(Progress.quiz_score))
+        )
+
+    # В SQLite нет percentile_cont: берем одно или два средних значения через OFFSET
+    total = await session.scalar(select(func.count(Progress.id)))
+    if not total:
+        return None
+    middle = select(Progress.quiz_score)\
+        .order_by(Progress.quiz_score)\
+        .offset((total - 1) // 2)\
+        .limit(2 - total % 2)\
+        .subquery()
+    return await session.scalar(select(func.avg(middle.c.quiz_score)))
+
+def active_users_query(day_ago: datetime, week_ago: datetime):
+    """Users active in the last day and week, counted from the last_activity index."""
+    return select(
+        func.count(UserStatistics.id).filter(UserStatistics.last_activity >= day_ago).label("active_day"),
+        func.count(UserStatistics.id).label("active_week")
+    ).filter(UserStatistics.last_activity >= week_ago)
+
+async def get_dashboard_stats() -> Optional[Dict]:
+    """Aggregate course statistics in the database for the admin dashboard.
+
+    Results are cached for DASHBOARD_CACHE_TTL seconds.
+    """
+    cached = _dashboard_cache.get("dashboard")
+    if cached is not None:
+        return cached
+
+    now = datetime.utcnow()
+    async with async_session_scope() as session:
+        try:
+            total_users = await session.scalar(select(func.count(UserStatistics.id)))
+            # Условие по неделе в WHERE дает просмотр диапазона индекса по last_activity
+            activity = (await session.execute(
+                active_users_query(now - timedelta(days=1), now - timedelta(days=7))
+            )).one()
+
+            lessons = await _read_lesson_funnel(session)
+            median_score = await _median_quiz_score(session)
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in get_dashboard_stats: {str(e)}")
+            return None
+
+    stats = {
+        "generated_at": now,
+        "total_users": total_users,
+        "active_day": activity.active_day,
+        "active_week": activity.active_week,
+        "median_score": float(median_score) if median_score is not None else None,
+        "lessons": lessons
+    }
+    _dashboard_cache.set("dashboard", stats)
+    logger.info(f"Dashboard statistics computed in {(datetime.utcnow() - now).total_seconds():.2f} seconds")
+    return stats
+
+class ProgressSummary:
+    """Compact per-user progress: completed lessons bitset, score sum and record count."""
+
+    __slots__ = ("completed_mask", "score_sum", "count")
+
+    def __init__(self):
+        self.completed_mask = 0
+        self.score_sum = 0
+        self.count = 0
+
+    def add(self, lesson_id: int, quiz_score: int, completed: bool = True) -> None:
+        self.score_sum += quiz_score
+        self.count += 1
+        if completed:
+            self.completed_mask |= 1 << lesson_id
+
+    def record(self, lesson_id: int, quiz_score: int, previous_score: Optional[int] = None) -> None:
+        """Apply a saved quiz result, replacing the previous score for the lesson if any."""
+        if previous_score is None:
+            self.add(lesson_id, quiz_score)
+        else:
+            self.score_sum += quiz_score - previous_score
+            self.completed_mask |= 1 << lesson_id
+
+    def is_completed(self, lesson_id: int) -> bool:
+        return bool(self.completed_mask >> lesson_id & 1)
+
+    @property
+    def completed_lessons(self) -> int:
+        return self.completed_mask.bit_count()
+
+    @property
+    def average_score(self) -> float:
+        return self.score_sum / self.count if self.count else 0.0
+
+PROGRESS_CACHE_SIZE = int(os.environ.get("PROGRESS_CACHE_SIZE", "10000"))
+PROGRESS_CACHE_TTL = int(os.environ.get("PROGRESS_CACHE_TTL", "60"))  # seconds
+
+_progress_cache = TTLCache(maxsize=PROGRESS_CACHE_SIZE, ttl=PROGRESS_CACHE_TTL)
+
+def _stats_update(user_id: int, score_delta, count_delta, now: datetime, **counters):
+    """Single UPDATE of the running score aggregates; deltas may be numbers or SQL expressions.
+
+    Extra keyword arguments are added to the counter columns of the same name.
+    """
+    score_sum = UserStatistics.score_sum + score_delta
+    score_count = UserStatistics.score_count + count_delta
+    values = {
+        name: getattr(UserStatistics, name) + delta
+        for name, delta in counters.items()
+    }
+    return update(UserStatistics).filter_by(user_id=user_id).values(
+        score_sum=score_sum,
+        score_count=score_count,
+        average_score=func.coalesce(score_sum * 1.0 / func.nullif(score_count, 0), 0.0),
+        last_activity=now,
+        **values
+    )
+
+FUNNEL_COUNTERS = ("users_reached", "users_completed", "attempts", "score_sum")
+
+def _funnel_row(lesson_id: int, now: datetime, **counters) -> Dict:
+    row = {"lesson_id": lesson_id, "updated_at": now}
+    for name in FUNNEL_COUNTERS:
+        row[name] = counters.get(name, 0)
+    return row
+
+def _funnel_upsert(insert, rows: List[Dict]):
+    """Add counter deltas to lesson_funnel rows, creating missing rows."""
+    statement = insert(LessonFunnel).values(rows)
+    set_ = {name: getattr(LessonFunnel, name) + getattr(statement.excluded, name) for name in FUNNEL_COUNTERS}
+    set_["updated_at"] = statement.excluded.updated_at
+    return statement.on_conflict_do_update(index_elements=[LessonFunnel.lesson_id], set_=set_)
+
+def _quiz_funnel_rows(lesson_id: int, score_delta, first_completion, next_lesson: Optional[int], now: datetime) -> List[Dict]:
+    """Funnel deltas for a saved quiz; the first completion also brings the user to the next lesson."""
+    rows = [_funnel_row(
+        lesson_id, now,
+        users_completed=first_completion,
+        attempts=1,
+        score_sum=score_delta
+    )]
+    if next_lesson is not None:
+        rows.append(_funnel_row(next_lesson, now, users_reached=first_completion))
+    return rows
+
+# Урок, открытый и забытый на несколько часов, не должен раздувать общее время
+MAX_LESSON_MINUTES = int(os.environ.get("MAX_LESSON_MINUTES", "120"))
+
+def _lesson_attempt_values(user_id: int, lesson_id: int, started_at: Optional[datetime], now: datetime,
+                           first_completion):
+    """The completed LessonAttempt row and the counters it adds to user_statistics.
+
+    first_completion (a number or SQL expression) is 1 only the first time the
+    lesson is completed, repeated completions do not add to completed_lessons.
+    """
+    started_at = started_at or now
+    minutes = min(max(round((now - started_at).total_seconds() / 60), 0), MAX_LESSON_MINUTES)
+    attempt = {
+        "user_id": user_id,
+        "lesson_id": lesson_id,
+        "started_at": started_at,
+        "completed_at": now,
+        "success": True
+    }
+    counters = {"total_time_spent": minutes, "total_attempts": 1, "completed_lessons": first_completion}
+    return attempt, counters
+
+def _dialect_insert(session):
+    return pg_insert if session.bind.dialect.name == "postgresql" else sqlite_insert
+
+async def get_user_progress(user_id: int) -> Optional[ProgressSummary]:
+    """Get the progress summary for a user, loading it once and then keeping it up to date."""
+    summary = _progress_cache.get(user_id)
+    if summary is not None:
+        return summary
+
+    async with async_session_scope() as session:
         try:
-            progress = session.query(Progress).filter_by(
-                user_id=user_id,
-                lesson_id=lesson_id
-            ).first()
-
-            if progress:
-                progress.quiz_score = quiz_score
-                progress.completed = True
-                progress.completed_at = datetime.utcnow()
-                progress.attempts += 1
+            rows = (await session.execute(
+                select(Progress.lesson_id, Progress.quiz_score, Progress.completed).filter_by(user_id=user_id)
+            )).all()
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in get_user_progress: {str(e)}")
+            return None
+
+    summary = ProgressSummary()
+    for lesson_id, quiz_score, completed in rows:
+        summary.add(lesson_id, quiz_score or 0, completed)
+    logger.info(f"Retrieved progress for user {user_id}: {summary.count} records")
+    _progress_cache.set(user_id, summary)
+    return summary
+
+def _progress_upsert(insert, user_id: int, lesson_id: int, quiz_score: int, now: datetime):
+    statement = insert(Progress).values(
+        user_id=user_id,
+        lesson_id=lesson_id,
+        quiz_score=quiz_score,
+        completed=True,
+        completed_at=now,
+        attempts=1
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[Progress.user_id, Progress.lesson_id],
+        set_={
+            "quiz_score": statement.excluded.quiz_score,
+            "completed": True,
+            "completed_at": statement.excluded.completed_at,
+            "attempts": Progress.attempts + 1
+        }
+    )
+
+async def _complete_quiz_postgresql(session, user_id: int, lesson_id: int, quiz_score: int, next_lesson: int,
+                                   started_at: Optional[datetime]):
+    """One statement: data-modifying CTEs upsert progress, record the attempt, update stats and the funnel,
+    advance the user."""
+    now = datetime.utcnow()
+    previous = select(Progress.quiz_score)\
+        .filter_by(user_id=user_id, lesson_id=lesson_id)\
+        .with_for_update()\
+        .cte("previous")
+    previous_score = select(previous.c.quiz_score).scalar_subquery()
+    had_previous = exists(select(previous.c.quiz_score))
+
+    upserted = _progress_upsert(pg_insert, user_id, lesson_id, quiz_score, now)\
+        .returning(Progress.attempts)\
+        .cte("upserted")
+    score_delta = quiz_score - func.coalesce(previous_score, 0)
+    first_completion = case((had_previous, 0), else_=1)
+    attempt_values, counters = _lesson_attempt_values(user_id, lesson_id, started_at, now, first_completion)
+    stats = _stats_update(user_id, score_delta, first_completion, now, **counters)\
+        .returning(UserStatistics.user_id)\
+        .cte("stats")
+    attempt = insert(LessonAttempt).values(**attempt_values)\
+        .returning(LessonAttempt.id)\
+        .cte("attempt")
+    funnel = _funnel_upsert(
+        pg_insert,
+        _quiz_funnel_rows(lesson_id, score_delta, first_completion, next_lesson, now)
+    ).returning(LessonFunnel.lesson_id).cte("funnel")
+    advanced = update(User).filter_by(id=user_id)\
+        .values(current_lesson=func.greatest(User.current_lesson, next_lesson))\
+        .returning(User.telegram_id, User.current_lesson)\
+        .cte("advanced")
+
+    row = (await session.execute(select(
+        previous_score.label("previous_score"),
+        had_previous.label("had_previous"),
+        select(upserted.c.attempts).scalar_subquery().label("attempts"),
+        select(stats.c.user_id).scalar_subquery().label("stats_user_id"),
+        select(attempt.c.id).scalar_subquery().label("attempt_id"),
+        select(func.count()).select_from(funnel).scalar_subquery().label("funnel_rows"),
+        select(advanced.c.telegram_id).scalar_subquery().label("telegram_id"),
+        select(advanced.c.current_lesson).scalar_subquery().label("current_lesson")
+    ))).one()
+    previous_score = row.previous_score if row.had_previous else None
+    return previous_score, row.telegram_id, row.current_lesson, 1
+
+async def _complete_quiz_stepwise(session, user_id: int, lesson_id: int, quiz_score: int, next_lesson: int,
+                                 started_at: Optional[datetime]):
+    """Same changes as separate statements in one transaction, for SQLite."""
+    now = datetime.utcnow()
+    previous = (await session.execute(
+        select(Progress.quiz_score).filter_by(user_id=user_id, lesson_id=lesson_id)
+    )).first()
+    previous_score = (previous.quiz_score or 0) if previous else None
+
+    await session.execute(_progress_upsert(sqlite_insert, user_id, lesson_id, quiz_score, now))
+    score_delta = quiz_score - (previous_score or 0)
+    first_completion = 0 if previous_score is not None else 1
+    attempt_values, counters = _lesson_attempt_values(user_id, lesson_id, started_at, now, first_completion)
+    await session.execute(_stats_update(user_id, score_delta, first_completion, now, **counters))
+    await session.execute(insert(LessonAttempt).values(**attempt_values))
+    await session.execute(_funnel_upsert(
+        sqlite_insert,
+        _quiz_funnel_rows(lesson_id, score_delta, first_completion, next_lesson, now)
+    ))
+    # Только вперед: устаревший кэш другого процесса не должен вернуть пользователя на прошлый урок
+    await session.execute(
+        update(User).filter(User.id == user_id, User.current_lesson < next_lesson).values(current_lesson=next_lesson)
+    )
+    user = (await session.execute(select(User.telegram_id, User.current_lesson).filter_by(id=user_id))).first()
+    if user is None:
+        return previous_score, None, None, 6
+    return previous_score, user.telegram_id, user.current_lesson, 7
+
+async def complete_quiz_and_advance(user_id: int, lesson_id: int, quiz_score: int, next_lesson: int,
+                                    started_at: Optional[datetime] = None) -> bool:
+    """Save a passed quiz, record the lesson attempt, update statistics and move the user
+    to the next lesson in one transaction.
+
+    The user never moves back: if another process already advanced them
+    further, current_lesson is kept and the cached progress is dropped.
+
+    started_at is when the user opened the lesson; the time spent is added to
+    total_time_spent. On PostgreSQL this is a single round-trip; caches are
+    updated after commit.
+    """
+    start_time = time.perf_counter()
+    async with async_session_scope() as session:
+        try:
+            if session.bind.dialect.name == "postgresql":
+                complete = _complete_quiz_postgresql
             else:
-                progress = Progress(
-                    user_id=user_id,
-                    lesson_id=lesson_id,
-                    quiz_score=quiz_score,
-                    completed=True,
-                    completed_at=datetime.utcnow()
-                )
-                session.add(progress)
+                complete = _complete_quiz_stepwise
+            previous_score, telegram_id, current_lesson, round_trips = await complete(
+                session, user_id, lesson_id, quiz_score, next_lesson, started_at
+            )
+            if telegram_id is None:
+                logger.warning(f"User {user_id} not found")
+                await session.rollback()
+                return False
+            await session.commit()
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in complete_quiz_and_advance: {str(e)}")
+            return False
 
-            # Обновляем статистику пользователя
-            stats = session.query(UserStatistics).filter_by(user_id=user_id).first()
-            if stats:
-                stats.last_activity = datetime.utcnow()
-                # Обновляем среднюю оценку
-                all_progress = session.query(Progress).filter_by(user_id=user_id).all()
-                avg_score = sum(p.quiz_score for p in all_progress) / len(all_progress) if all_progress else 0  # Handle empty progress list
-                stats.average_score = avg_score
+    _cache_user(CachedUser(user_id, telegram_id, current_lesson))
+    if current_lesson != next_lesson:
+        # Пользователя уже продвинул другой процесс, значит и сводка прогресса здесь устарела
+        _progress_cache.pop(user_id)
+    else:
+        summary = _progress_cache.get(user_id)
+        if summary is not None:
+            summary.record(lesson_id, quiz_score, previous_score)
 
-            session.commit()
-            logger.info(f"Updated progress for user {user_id}, lesson {lesson_id}")
+    logger.info(
+        f"Completed quiz {lesson_id} for user {user_id}, current lesson {current_lesson} "
+        f"in {(time.perf_counter() - start_time) * 1000:.1f} ms ({round_trips} round trips + commit)"
+    )
+    return True
+
+async def get_cached_response(cache_key: str) -> Optional[str]:
+    """Get a stored AI response if it has not expired."""
+    async with async_session_scope() as session:
+        try:
+            return await session.scalar(select(AIResponseCache.response).filter(
+                AIResponseCache.cache_key == cache_key,
+                AIResponseCache.expires_at > datetime.utcnow()
+            ))
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in get_cached_response: {str(e)}")
+            return None
+
+async def store_cached_response(cache_key: str, kind: str, prompt: str, response: str, ttl: int) -> bool:
+    """Insert or replace a stored AI response."""
+    async with async_session_scope() as session:
+        try:
+            now = datetime.utcnow()
+            await session.merge(AIResponseCache(
+                cache_key=cache_key,
+                kind=kind,
+                prompt=prompt,
+                response=response,
+                created_at=now,
+                expires_at=now + timedelta(seconds=ttl)
+            ))
+            await session.commit()
             return True
         except SQLAlchemyError as e:
-            logger.error(f"Database error in update_progress: {str(e)}")
+            logger.error(f"Database error in store_cached_response: {str(e)}")
             return False
 
-@lru_cache(maxsize=50)
-def get_user_progress(user_id: int) -> List[Progress]:
-    """Get all progress records for a user using optimized query."""
-    with session_scope() as session:
+async def get_cached_prompts(kind: str, limit: int) -> List[str]:
+    """Get the most recent non-expired cache keys of one kind."""
+    async with async_session_scope() as session:
         try:
-            progress = session.query(Progress).options(
-                joinedload(Progress.user)
-            ).filter_by(user_id=user_id).all()
-            logger.info(f"Retrieved progress for user {user_id}: {len(progress)} records")
-            return progress
+            prompts = await session.scalars(select(AIResponseCache.prompt).filter(
+                AIResponseCache.kind == kind,
+                AIResponseCache.expires_at > datetime.utcnow()
+            ).order_by(AIResponseCache.created_at.desc()).limit(limit))
+            return list(prompts)
         except SQLAlchemyError as e:
-            logger.error(f"Database error in get_user_progress: {str(e)}")
+            logger.error(f"Database error in get_cached_prompts: {str(e)}")
             return []
 
-def update_user_lesson(user_id: int, new_lesson: int) -> bool:
-    """Update user's current lesson with improved error handling."""
-    with session_scope() as session:
+async def prune_cached_responses(max_entries: int) -> int:
+    """Delete expired AI responses and the oldest ones above max_entries."""
+    async with async_session_scope() as session:
         try:
-            session.flush()
-            user = session.query(User).get(user_id)
-            session.refresh(user)
+            result = await session.execute(delete(AIResponseCache).filter(
+                AIResponseCache.expires_at <= datetime.utcnow()
+            ))
+            deleted = result.rowcount
 
-            if user:
-                old_lesson = user.current_lesson
-                logger.info(f"Updating lesson for user {user_id} from {old_lesson} to {new_lesson}")
+            overflow = await session.scalar(select(func.count(AIResponseCache.cache_key))) - max_entries
+            if overflow > 0:
+                oldest = select(AIResponseCache.cache_key)\
+                    .order_by(AIResponseCache.created_at)\
+                    .limit(overflow)\
+                    .scalar_subquery()
+                result = await session.execute(delete(AIResponseCache).filter(
+                    AIResponseCache.cache_key.in_(oldest)
+                ))
+                deleted += result.rowcount
 
-                user.current_lesson = new_lesson
+            await session.commit()
+            if deleted:
+                logger.info(f"Pruned {deleted} cached AI responses")
+            return deleted
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in prune_cached_responses: {str(e)}")
+            return 0
 
-                # Обновляем время последней активности
-                stats = session.query(UserStatistics).filter_by(user_id=user_id).first()
-                if stats:
-                    stats.last_activity = datetime.utcnow()
+async def count_history_items() -> int:
+    """Count history items that have not been served yet."""
+    async with async_session_scope() as session:
+        try:
+            return await session.scalar(
+                select(func.count(HistoryItem.id)).filter(HistoryItem.served_at.is_(None))
+            )
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in count_history_items: {str(e)}")
+            return 0
 
-                session.commit()
-                get_cached_user.cache_clear()
+async def add_history_items(items: List[Dict]) -> int:
+    """Add generated history items to the pool, skipping duplicates."""
+    if not items:
+        return 0
+    async with async_session_scope() as session:
+        try:
+            unique_items = {item['content_hash']: item for item in items}
+            existing = set(await session.scalars(
+                select(HistoryItem.content_hash).filter(HistoryItem.content_hash.in_(list(unique_items)))
+            ))
+            new_items = [item for content_hash, item in unique_items.items() if content_hash not in existing]
+            session.add_all([HistoryItem(**item) for item in new_items])
+            await session.commit()
+            logger.info(f"Added {len(new_items)} history items, skipped {len(items) - len(new_items)} duplicates")
+            return len(new_items)
+        except IntegrityError:
+            # Параллельное пополнение уже добавило такую же справку
+            logger.warning("Duplicate history item on insert, skipping batch")
+            await session.rollback()
+            return 0
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in add_history_items: {str(e)}")
+            return 0
+
+async def pop_history_item() -> Tuple[Optional[Dict], int]:
+    """Take the oldest unserved history item and return it with the remaining pool size."""
+    async with async_session_scope() as session:
+        try:
+            item = await session.scalar(
+                select(HistoryItem)
+                .filter(HistoryItem.served_at.is_(None))
+                .order_by(HistoryItem.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+            if not item:
+                return None, 0
+
+            item.served_at = datetime.utcnow()
+            data = {
+                "history": item.history,
+                "question": item.question,
+                "correct_answer": item.correct_answer,
+                "explanation": item.explanation
+            }
+            await session.commit()
+
+            remaining = await session.scalar(
+                select(func.count(HistoryItem.id)).filter(HistoryItem.served_at.is_(None))
+            )
+            return data, remaining
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in pop_history_item: {str(e)}")
+            return None, 0
+
+def _meme_asset_to_dict(asset: MemeAsset) -> Dict:
+    return {
+        "id": asset.id,
+        "concept_key": asset.concept_key,
+        "file_path": asset.file_path,
+        "telegram_file_id": asset.telegram_file_id
+    }
+
+async def get_meme_assets(concept_key: str) -> List[Dict]:
+    """Get stored meme variants for a concept that can still be sent."""
+    async with async_session_scope() as session:
+        try:
+            assets = await session.scalars(select(MemeAsset).filter(
+                MemeAsset.concept_key == concept_key,
+                (MemeAsset.file_path.isnot(None)) | (MemeAsset.telegram_file_id.isnot(None))
+            ))
+            return [_meme_asset_to_dict(asset) for asset in assets]
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in get_meme_assets: {str(e)}")
+            return []
+
+async def add_meme_asset(concept_key: str, file_path: str, file_size: int) -> Optional[Dict]:
+    """Register a downloaded meme image."""
+    async with async_session_scope() as session:
+        try:
+            asset = MemeAsset(concept_key=concept_key, file_path=file_path, file_size=file_size)
+            session.add(asset)
+            await session.commit()
+            return _meme_asset_to_dict(asset)
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in add_meme_asset: {str(e)}")
+            return None
+
+async def touch_meme_asset(asset_id: int, telegram_file_id: Optional[str] = None) -> bool:
+    """Mark a meme as recently used and remember its Telegram file_id."""
+    async with async_session_scope() as session:
+        try:
+            values = {"last_used_at": datetime.utcnow()}
+            if telegram_file_id:
+                values["telegram_file_id"] = telegram_file_id
+            await session.execute(update(MemeAsset).filter_by(id=asset_id).values(**values))
+            await session.commit()
+            return True
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in touch_meme_asset: {str(e)}")
+            return False
+
+async def evict_meme_files(max_bytes: int) -> List[str]:
+    """Release least recently used meme files until storage fits max_bytes.
+
+    Assets with a Telegram file_id stay usable without the local file,
+    others are removed. Returns the paths of files to delete.
+    """
+    async with async_session_scope() as session:
+        try:
+            used = await session.scalar(
+                select(func.coalesce(func.sum(MemeAsset.file_size), 0))
+                .filter(MemeAsset.file_path.isnot(None))
+            )
+            if used <= max_bytes:
+                return []
 
-                session.refresh(user)
-                if user.current_lesson == new_lesson:
-                    logger.info(f"Successfully updated lesson to {new_lesson} for user {user_id}")
-                    return True
+            paths = []
+            candidates = (await session.scalars(
+                select(MemeAsset)
+                .filter(MemeAsset.file_path.isnot(None))
+                .order_by(MemeAsset.last_used_at)
+            )).all()
+            for asset in candidates:
+                if used <= max_bytes:
+                    break
+                used -= asset.file_size or 0
+                paths.append(asset.file_path)
+                if asset.telegram_file_id:
+                    asset.file_path = None
+                    asset.file_size = 0
                 else:
-                    logger.error(f"Lesson update verification failed for user {user_id}")
-                    return False
+                    await session.delete(asset)
 
-            logger.warning(f"User {user_id} not found")
+            await session.commit()
+            logger.info(f"Evicted {len(paths)} meme files, storage now {used} bytes")
+            return paths
+        except SQLAlchemyError as e:
+            logger.error(f"Database error in evict_meme_files: {str(e)}")
+            return []
+
+async def load_user_state(telegram_id: int) -> Optional[Dict]:
+    """Get the stored conversation state of one user.
+
+    Returns an empty dict if nothing is stored and None if the read failed.
+    """
+    async with async_session_scope() as session:
+        try:
+            data = await session.scalar(select(UserState.data).filter_by(telegram_id=telegram_id))
+        except SQLAlchemyError as e:
+            logger.error(f"Error loading state of user {telegram_id}: {str(e)}")
+            return None
+    try:
+        return json.loads(data) if data else {}
+    except ValueError as e:
+        # Битое состояние повторное чтение не исправит, начинаем с пустого
+        logger.error(f"Stored state of user {telegram_id} is not valid JSON: {str(e)}")
+        return {}
+
+async def save_user_states(states: Dict[int, Dict]) -> bool:
+    """Write conversation states of many users, one upsert for the batch.
+
+    Users whose state became empty are deleted instead of stored.
+    """
+    now = datetime.utcnow()
+    rows, empty = [], []
+    for telegram_id, data in states.items():
+        if not data:
+            empty.append(telegram_id)
+            continue
+        try:
+            rows.append({"telegram_id": telegram_id, "data": json.dumps(data, ensure_ascii=False), "updated_at": now})
+        except (TypeError, ValueError) as e:
+            # Несериализуемое состояние не должно блокировать запись остальных пользователей
+            logger.error(f"State of user {telegram_id} is not JSON serializable: {str(e)}")
+    async with async_session_scope() as session:
+        try:
+            if rows:
+                stmt = _dialect_insert(session)(UserState).values(rows)
+                await session.execute(stmt.on_conflict_do_update(
+                    index_elements=[UserState.telegram_id],
+                    set_={"data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at}
+                ))
+            if empty:
+                await session.execute(delete(UserState).filter(UserState.telegram_id.in_(empty)))
+            await session.commit()
+            return True
+        except SQLAlchemyError as e:
+            logger.error(f"Error saving states of {len(states)} users: {str(e)}")
             return False
 
+async def delete_user_state(telegram_id: int) -> bool:
+    async with async_session_scope() as session:
+        try:
+            await session.execute(delete(UserState).filter_by(telegram_id=telegram_id))
+            await session.commit()
+            return True
         except SQLAlchemyError as e:
-            logger.error(f"Database error in update_user_lesson: {str(e)}")
-            return False
\ No newline at end of file
+            logger.error(f"Error deleting state of user {telegram_id}: {str(e)}")
+            return False
@@ -0,0 +1,102 @@
+"""EXPLAIN-based check that the hot queries are served by indexes.
+
+Each query is explained on the configured database. On PostgreSQL
+sequential scans are disabled for the check, so a Seq Scan in the plan
+means no usable index exists rather than a small table being cheaper to
+scan. On SQLite a bare "SCAN <table>" step is reported.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Iterator, List, NamedTuple, Tuple
+from sqlalchemy import bindparam, func, select, text
+from sqlalchemy.engine import Connection, Engine
+from models import User, Progress, UserStatistics, LessonAttempt, HistoryItem, AIResponseCache, MemeAsset
+from utils.db_utils import active_users_query
+
+logger = logging.getLogger(__name__)
+
+INDEX_NODE_TYPES = {"Index Scan", "Index Only Scan", "Bitmap Heap Scan"}
+
+class HotQuery(NamedTuple):
+    name: str
+    tables: Tuple[str, ...]
+    statement: object
+
+def hot_queries() -> List[HotQuery]:
+    """Queries run per message or per admin page, with representative parameters."""
+    now = datetime.utcnow()
+    return [
+        HotQuery("user by telegram_id", ("users",),
+                 select(User.id, User.telegram_id, User.current_lesson).filter_by(telegram_id=1)),
+        HotQuery("progress summary", ("progress",),
+                 select(Progress.lesson_id, Progress.quiz_score, Progress.completed).filter_by(user_id=1)),
+        HotQuery("progress row for upsert", ("progress",),
+                 select(Progress.id).filter_by(user_id=1, lesson_id=1)),
+        HotQuery("completed users per lesson", ("progress",),
+                 select(func.count(Progress.id)).filter(Progress.lesson_id == 1, Progress.completed.is_(True))),
+        HotQuery("user statistics", ("user_statistics",),
+                 select(UserStatistics).filter_by(user_id=1)),
+        HotQuery("active users", ("user_statistics",),
+                 active_users_query(now - timedelta(days=1), now - timedelta(days=7))),
+        HotQuery("statistics page", ("users", "user_statistics"),
+                 select(User.id, UserStatistics.average_score)
+                 .join(UserStatistics, UserStatistics.user_id == User.id)
+                 .filter(User.id > 0).order_by(User.id).limit(20)),
+        HotQuery("user lesson attempts", ("lesson_attempts",),
+                 select(func.count(LessonAttempt.id)).filter_by(user_id=1)),
+        HotQuery("unserved history items", ("history_items",),
+                 select(func.count(HistoryItem.id)).filter(HistoryItem.served_at.is_(None))),
+        HotQuery("ai response cache", ("ai_response_cache",),
+                 select(AIResponseCache.response).filter(
+                     AIResponseCache.cache_key == "key", AIResponseCache.expires_at > now)),
+        HotQuery("meme assets", ("meme_assets",),
+                 select(MemeAsset.id).filter(MemeAsset.concept_key == "concept")),
+    ]
+
+def _explain(connection: Connection, statement, prefix: str):
+    # Компилируем с именованными параметрами, чтобы передать их в text() с исходными типами
+    dialect = connection.dialect.__class__(paramstyle="named")
+    compiled = statement.compile(dialect=dialect)
+    params = [bindparam(name, value=bind.effective_value, type_=bind.type) for bind, name in compiled.bind_names.items()]
+    return connection.execute(text(f"{prefix} {compiled.string}").bindparams(*params)).all()
+
+def _postgresql_nodes(plan) -> Iterator[dict]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _postgresql_nodes(child)
+
+def _check_postgresql(connection: Connection, query: HotQuery) -> Tuple[bool, str]:
+    connection.execute(text("SET LOCAL enable_seqscan = off"))
+    plan = _explain(connection, query.statement, "EXPLAIN (FORMAT JSON)")[0][0][0]["Plan"]
+    steps = [
+        f"{node['Node Type']} on {node['Relation Name']}" + (f" using {node['Index Name']}" if "Index Name" in node else "")
+        for node in _postgresql_nodes(plan) if node.get("Relation Name") in query.tables
+    ]
+    uses_index = all(
+        node["Node Type"] in INDEX_NODE_TYPES
+        for node in _postgresql_nodes(plan) if node.get("Relation Name") in query.tables
+    )
+    return uses_index and bool(steps), "; ".join(steps)
+
+def _check_sqlite(connection: Connection, query: HotQuery) -> Tuple[bool, str]:
+    details = [row[3] for row in _explain(connection, query.statement, "EXPLAIN QUERY PLAN")]
+    steps = [
+        detail for detail in details
+        if detail.split(" ")[0] in ("SCAN", "SEARCH") and detail.split(" ")[1] in query.tables
+    ]
+    uses_index = all(" USING " in step for step in steps)
+    return uses_index and bool(steps), "; ".join(steps)
+
+def check_query_plans(engine: Engine) -> List[Tuple[str, bool, str]]:
+    """Explain every hot query, returns (name, uses_index, plan summary) tuples."""
+    check = _check_postgresql if engine.dialect.name == "postgresql" else _check_sqlite
+    results = []
+    for query in hot_queries():
+        # Каждый запрос в своей транзакции, SET LOCAL не выходит за ее пределы
+        with engine.connect() as connection:
+            with connection.begin():
+                uses_index, summary = check(connection, query)
+        results.append((query.name, uses_index, summary))
+        if not uses_index:
+            logger.warning(f"Hot query '{query.name}' is not served by an index: {summary}")
+    return results
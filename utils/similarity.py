@@ -0,0 +1,105 @@
+import logging
+import math
+import importlib.util
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Импорт NumPy заметно удлиняет запуск, поэтому он откладывается до создания первого индекса
+np = None
+
+def numpy_installed() -> bool:
+    """Check whether NumPy can be imported without importing it."""
+    return importlib.util.find_spec("numpy") is not None
+
+def _load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+class SimilarityIndex:
+    """TF-IDF index over normalized keys with a cosine similarity threshold.
+
+    Keys are whitespace-separated tokens as produced by normalize_query.
+    The matrix is rebuilt lazily on the first lookup after a change.
+    """
+
+    def __init__(self, threshold: float = 0.85, max_entries: int = 1000):
+        try:
+            _load_numpy()
+        except ImportError:
+            raise RuntimeError("NumPy is required for SimilarityIndex")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._keys: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._vocabulary: Dict[str, int] = {}
+        self._idf = None
+        self._matrix = None
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: str) -> None:
+        if not key or key in self._keys:
+            return
+        self._keys[key] = key.split()
+        while len(self._keys) > self.max_entries:
+            self._keys.popitem(last=False)
+        self._dirty = True
+
+    def _rebuild(self) -> None:
+        keys = list(self._keys.values())
+        self._vocabulary = {}
+        for tokens in keys:
+            for token in tokens:
+                self._vocabulary.setdefault(token, len(self._vocabulary))
+
+        counts = np.zeros((len(keys), len(self._vocabulary)), dtype=np.float32)
+        for row, tokens in enumerate(keys):
+            for token in tokens:
+                counts[row, self._vocabulary[token]] += 1
+
+        document_frequency = (counts > 0).sum(axis=0)
+        self._idf = np.log((1 + len(keys)) / (1 + document_frequency)) + 1
+        matrix = counts * self._idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self._matrix = matrix / norms
+        self._dirty = False
+
+    def find(self, key: str) -> Optional[str]:
+        """Return the most similar stored key above the threshold, if any."""
+        if not key or not self._keys:
+            return None
+        if key in self._keys:
+            return key
+        if self._dirty:
+            self._rebuild()
+
+        vector = np.zeros(len(self._vocabulary), dtype=np.float32)
+        # Незнакомые слова не совпадают ни с чем, но уменьшают сходство
+        unknown_weight = math.log(1 + len(self._keys)) + 1
+        unknown_norm = 0.0
+        for token in key.split():
+            column = self._vocabulary.get(token)
+            if column is None:
+                unknown_norm += unknown_weight ** 2
+            else:
+                vector[column] += self._idf[column]
+
+        norm = math.sqrt(float(vector @ vector) + unknown_norm)
+        if norm == 0:
+            return None
+
+        scores = self._matrix @ (vector / norm)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+
+        match = list(self._keys)[best]
+        logger.debug(f"Similar cached key for '{key}': '{match}' ({scores[best]:.2f})")
+        return match
@@ -0,0 +1,35 @@
+import time
+import logging
+from contextlib import contextmanager
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+class StartupTimer:
+    """Collects how long each startup phase took and logs one summary line."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases: List[Tuple[str, float]] = []
+        self.reported = False
+
+    def record(self, name: str, started_at: float) -> None:
+        self.phases.append((name, time.perf_counter() - started_at))
+
+    @contextmanager
+    def phase(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started_at)
+
+    def report(self) -> None:
+        if self.reported:
+            return
+        self.reported = True
+        total = time.perf_counter() - self.started_at
+        breakdown = ", ".join(f"{name} {duration:.2f}s" for name, duration in self.phases)
+        logger.info(f"Startup took {total:.2f} seconds: {breakdown}")
+
+startup_timer = StartupTimer()
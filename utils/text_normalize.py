@@ -0,0 +1,49 @@
+import re
+from functools import lru_cache
+
+# Слова-связки, которые не меняют смысл вопроса
+STOPWORDS = frozenset({
+    "что", "такое", "такой", "такая", "это", "этот", "эта",
+    "объясни", "объясните", "расскажи", "расскажите", "опиши", "опишите",
+    "пожалуйста", "мне", "нам", "про", "о", "об", "ли", "же", "ну", "вообще",
+    "кратко", "простыми", "словами",
+    "what", "is", "are", "the", "a", "an", "explain", "please", "about",
+})
+
+# Окончания для простого стемминга, от длинных к коротким
+ENDINGS = sorted({
+    "иями", "ями", "ами", "иях", "ого", "его", "ому", "ему", "ыми", "ими",
+    "ая", "яя", "ое", "ее", "ые", "ие", "ый", "ий", "ой", "ом", "ем", "ах", "ях",
+    "ую", "юю", "ия", "ья", "ию", "ью", "ей", "ов", "ев", "ам", "ям",
+    "ает", "яет", "ует", "ить", "ать", "ять", "ают", "яют",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+}, key=len, reverse=True)
+
+MIN_STEM_LENGTH = 3
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+
+def stem(word: str) -> str:
+    """Strip one common Russian inflectional ending from a word."""
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+@lru_cache(maxsize=1000)
+def normalize_query(text: str) -> str:
+    """Normalize a question or topic into a cache key.
+
+    Lowercases, drops punctuation and filler words, collapses whitespace and
+    stems each remaining word, so that "Градиентный спуск?" and
+    "что такое градиентный  спуск" produce the same key.
+    """
+    if not text:
+        return ""
+    lowered = text.lower().replace("ё", "е")
+    words = _PUNCTUATION_RE.sub(" ", lowered).split()
+    tokens = [stem(word) for word in words if word not in STOPWORDS]
+    if not tokens:
+        # Вопрос целиком из стоп-слов: оставляем слова как есть
+        tokens = words
+    return " ".join(tokens)